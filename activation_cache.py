@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from typing import Dict, Optional
+
+class ActivationCache:
+    """
+    On-disk, content-addressed cache of pooled per-layer activation state.
+
+    Entries are keyed by a hash of (model id, layer, tokenizer fingerprint,
+    text hash and any setting that changes the activations) and hold the
+    pooling state of a transcript (count, sum, max, first and last row), from
+    which every pooling in SAEExtractor.stats / ClsExtractor.stats can be
+    rebuilt. Mostly-zero states (SAE latents) are stored in CSR form. Total
+    size is capped at max_bytes: once over it, least recently used entries
+    are evicted down to LOW_WATER of the cap.
+    """
+    ROWS = ('sum', 'max', 'first', 'last')
+    LOW_WATER = 0.9
+    # share of max_bytes put by this process between re-reads of the size on
+    # disk, which also counts the puts of other processes sharing the cache
+    RESCAN = 0.02
+
+    def __init__(self, root: str, max_bytes: int = 20 * 2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+        self.hits = 0
+        self.misses = 0
+
+    def _scan(self):
+        """Rebuild the index and total size from the files on disk."""
+        self._index = {}  # path -> (last use, size)
+        for dirpath, _, files in os.walk(self.root):
+            for fname in files:
+                if fname.endswith('.npz'):
+                    path = os.path.join(dirpath, fname)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:  # evicted by another process meanwhile
+                        continue
+                    self._index[path] = (st.st_mtime, st.st_size)
+        self.total_bytes = sum(size for _, size in self._index.values())
+        self._unscanned = 0
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.npz")
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                if 'arr' in data:
+                    rows = data['arr']
+                else:
+                    rows = np.zeros(tuple(data['shape']), dtype=data['data'].dtype)
+                    indptr, indices = data['indptr'], data['indices']
+                    for r in range(rows.shape[0]):
+                        rows[r, indices[indptr[r]:indptr[r + 1]]] = data['data'][indptr[r]:indptr[r + 1]]
+                count = int(data['count'])
+            os.utime(path)  # recency survives restarts through the file mtime
+        except (OSError, ValueError, KeyError):
+            # missing, evicted by another process, or a torn write: recompute
+            self.misses += 1
+            return None
+        size = self._index[path][1] if path in self._index else os.path.getsize(path)
+        self._index[path] = (time.time(), size)
+        self.hits += 1
+        state = dict(zip(self.ROWS, rows))
+        state['count'] = count
+        return state
+
+    def put(self, key: str, state: Dict[str, np.ndarray]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rows = np.stack([state[name] for name in self.ROWS])
+        nz = np.nonzero(rows)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            if len(nz[0]) <= rows.size // 4:
+                indptr = np.searchsorted(nz[0], np.arange(rows.shape[0] + 1))
+                np.savez(f, count=state['count'], shape=rows.shape, data=rows[nz],
+                         indices=nz[1], indptr=indptr)
+            else:
+                np.savez(f, count=state['count'], arr=rows)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        added = size - self._index.get(path, (0, 0))[1]
+        self.total_bytes += added
+        self._unscanned += added
+        self._index[path] = (time.time(), size)
+        if self.total_bytes > self.max_bytes or self._unscanned > self.RESCAN * self.max_bytes:
+            self._scan()
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Drop least recently used entries until the cache is down to LOW_WATER
+        of its cap, so the index is sorted once per batch of evictions rather
+        than on every put.
+        """
+        target = self.LOW_WATER * self.max_bytes
+        for path, (_, size) in sorted(self._index.items(), key=lambda kv: kv[1][0]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            del self._index[path]
+            self.total_bytes -= size
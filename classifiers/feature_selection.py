@@ -1,40 +1,368 @@
 import os
+import re
+import sys
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy import special
 from sklearn.feature_selection import SelectKBest, f_classif
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.feature_selection import SelectFromModel
 
+# classifier scripts run from this directory; make the project root importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from feature_store import FeatureStore
 
-def load_features(feature_dir: str):
+# <stat>[_layer<L>]_<first_id>_<last_id>.npz
+SHARD_RE = re.compile(r'^([a-z]+(?:_layer\d+)?)_(.+)\.npz$')
+
+
+def load_shard(path: str):
+    """
+    Load one feature shard: a dense npz (key 'arr') or a scipy CSR npz.
+    """
+    with np.load(path) as data:
+        if 'arr' in data:
+            return data['arr']  # (batch, feat_dim)
+    return sp.load_npz(path).tocsr()
+
+
+def _has_features(d: str) -> bool:
+    return FeatureStore.exists(d) or any(SHARD_RE.match(f) for f in os.listdir(d))
+
+
+def feature_dirs(feature_dir: str) -> list:
+    """
+    The directory itself if it holds features, otherwise its split
+    subdirectories (e.g. <sae_id>/2012_1, <sae_id>/2012_2, ...) in sorted order.
+    """
+    if _has_features(feature_dir):
+        return [feature_dir]
+    subdirs = sorted(
+        os.path.join(feature_dir, d) for d in os.listdir(feature_dir)
+        if os.path.isdir(os.path.join(feature_dir, d)) and _has_features(os.path.join(feature_dir, d))
+    )
+    if not subdirs:
+        raise FileNotFoundError(f"No feature shards or store under {feature_dir}")
+    return subdirs
+
+
+def available_views(feature_dir: str) -> list:
+    """Names of the (stat, layer) views stored in a feature directory."""
+    if FeatureStore.exists(feature_dir):
+        return FeatureStore(feature_dir).views()
+    return sorted({m.group(1) for m in map(SHARD_RE.match, os.listdir(feature_dir)) if m})
+
+
+def _resolve_view(feature_dir: str, view: str = None) -> str:
+    views = available_views(feature_dir)
+    if view is None:
+        if len(views) != 1:
+            raise ValueError(f"{feature_dir} holds several views {views}; pick one with view=")
+        return views[0]
+    if view not in views:
+        raise ValueError(f"No view '{view}' in {feature_dir}; available: {views}")
+    return view
+
+
+def _shard_files(feature_dir: str, view: str) -> list:
+    """(shard path, metadata path) pairs of one view, in row order."""
+    layer = re.search(r'_layer\d+$', view)
+    layer_suffix = layer.group(0) if layer else ''
+    pairs = []
+    for f in sorted(os.listdir(feature_dir)):
+        m = SHARD_RE.match(f)
+        if not m or m.group(1) != view:
+            continue
+        # each shard pairs with the metadata file covering the same id range
+        meta_path = os.path.join(feature_dir, f"meta{layer_suffix}_{m.group(2)}.csv")
+        pairs.append((os.path.join(feature_dir, f), meta_path))
+    return pairs
+
+
+def _load_dir(feature_dir: str, view: str = None, cols: np.ndarray = None):
+    view = _resolve_view(feature_dir, view)
+    if FeatureStore.exists(feature_dir):
+        store = FeatureStore(feature_dir)
+        # without a column subset, hand back the memory map itself
+        X = store.open(view) if cols is None else store.select(view, cols=cols)
+        return X, store.load_meta()
+    X_list, metas = [], []
+    for shard_path, meta_path in _shard_files(feature_dir, view):
+        x = load_shard(shard_path)
+        X_list.append(x if cols is None else x[:, cols])
+        metas.append(pd.read_csv(meta_path).set_index('transcript_id'))
+    return _stack(X_list), pd.concat(metas)
+
+
+def _load_meta(feature_dir: str, view: str = None) -> pd.DataFrame:
+    view = _resolve_view(feature_dir, view)
+    if FeatureStore.exists(feature_dir):
+        return FeatureStore(feature_dir).load_meta()
+    return pd.concat([pd.read_csv(meta_path).set_index('transcript_id')
+                      for _, meta_path in _shard_files(feature_dir, view)])
+
+
+def _stack(X_list: list):
+    if len(X_list) == 1:
+        return X_list[0]
+    if any(sp.issparse(x) for x in X_list):
+        return sp.vstack([sp.csr_matrix(x) for x in X_list], format='csr')
+    return np.vstack(X_list)
+
+
+def load_features(feature_dir: str, view: str = None, cols: np.ndarray = None):
     """
-    Load stacked features and metadata CSV from a directory.
+    Load one feature view (e.g. 'mean_layer20') and its labels from a feature
+    directory, or from every split subdirectory under it.
     Returns X (num_samples, num_features), y (labels), ids (list of transcript_ids).
-    Assumes: .npz files named <feat>_start_end.npz, and meta_start_end.csv.
-    """
-    npz_files = sorted([f for f in os.listdir(feature_dir) if f.endswith('.npz')])
-    csv_files = sorted([f for f in os.listdir(feature_dir) if f.startswith('meta') and f.endswith('.csv')])
-    X_list, ids_list = [], []
-    for npz in npz_files:
-        data = np.load(os.path.join(feature_dir, npz))['arr']  # (batch, feat_dim)
-        X_list.append(data)
-    X = np.vstack(X_list)
-    metas = [pd.read_csv(os.path.join(feature_dir, csv)).set_index('transcript_id') for csv in csv_files]
-    meta = pd.concat(metas)
+    Reads .npz shards named <view>_start_end.npz paired with
+    meta[_layer<L>]_start_end.csv, or a FeatureStore. `view` may be omitted
+    when the directory holds a single view; `cols` loads only those columns.
+    If any shard is sparse, X is a CSR matrix and is never densified. A single
+    FeatureStore without `cols` is returned as a read-only memory map.
+    """
+    parts = [_load_dir(d, view, cols) for d in feature_dirs(feature_dir)]
+    X = _stack([X_part for X_part, _ in parts])
+    meta = pd.concat([meta_part for _, meta_part in parts])
     y = meta['label'].values
     ids = meta.index.tolist()
     return X, y, ids
 
 
+def load_labels(feature_dir: str, view: str = None):
+    """Labels and transcript_ids of a feature directory, without reading any features."""
+    meta = pd.concat([_load_meta(d, view) for d in feature_dirs(feature_dir)])
+    return meta['label'].values, meta.index.tolist()
+
+
+def iter_feature_chunks(feature_dir: str, view: str = None, rows: np.ndarray = None,
+                        chunk_rows: int = 4096):
+    """
+    Yield (X_block, y_block) over the rows of one view in load_features
+    order, optionally restricted to the global row indices in `rows`. At most
+    one block (plus, for shard directories, one shard) is held in memory.
+    Sparse shards yield CSR blocks.
+    """
+    rows = None if rows is None else np.sort(np.asarray(rows))
+    offset = 0
+    for d in feature_dirs(feature_dir):
+        d_view = _resolve_view(d, view)
+        if FeatureStore.exists(d):
+            store = FeatureStore(d)
+            n = store.num_rows
+            labels = store.load_meta()['label'].values
+            local = None if rows is None else rows[(rows >= offset) & (rows < offset + n)] - offset
+            for start, block in store.iter_chunks(d_view, chunk_rows, rows=local):
+                block_rows = np.arange(start, start + len(block)) if local is None else local[start:start + len(block)]
+                yield np.asarray(block), labels[block_rows]
+            offset += n
+            continue
+        for shard_path, meta_path in _shard_files(d, d_view):
+            x = load_shard(shard_path)
+            labels = pd.read_csv(meta_path)['label'].values
+            n = x.shape[0]
+            local = np.arange(n) if rows is None else rows[(rows >= offset) & (rows < offset + n)] - offset
+            for start in range(0, len(local), chunk_rows):
+                block_rows = local[start:start + chunk_rows]
+                yield x[block_rows], labels[block_rows]
+            offset += n
+
+
+def _rebatch(blocks, chunk_rows: int):
+    """
+    Regroup (X_block, y_block) pairs, e.g. one or more per shard from
+    iter_feature_chunks, into blocks of exactly chunk_rows rows (the last
+    may be shorter).
+    """
+    xs, ys, n = [], [], 0
+    for X_block, y_block in blocks:
+        xs.append(X_block)
+        ys.append(y_block)
+        n += len(y_block)
+        if n < chunk_rows:
+            continue
+        X, y = _stack(xs), np.concatenate(ys)
+        for start in range(0, n - chunk_rows + 1, chunk_rows):
+            yield X[start:start + chunk_rows], y[start:start + chunk_rows]
+        done = n - n % chunk_rows
+        xs, ys, n = ([X[done:]], [y[done:]], n - done) if n > done else ([], [], 0)
+    if n:
+        yield _stack(xs), np.concatenate(ys)
+
+
+def load_rows(feature_dir: str, view: str = None, rows: np.ndarray = None, chunk_rows: int = 4096):
+    """
+    The given global rows of one view (in the order given), read chunk by
+    chunk so only those rows are ever materialised. Sparse shards give CSR.
+    """
+    rows = np.asarray(rows)
+    order = np.sort(rows)
+    X = _stack([X_block for X_block, _ in iter_feature_chunks(feature_dir, view, order, chunk_rows)])
+    return X[np.searchsorted(order, rows)]
+
+
+def row_reader(feature_dir: str, view: str = None):
+    """
+    Random access to the rows of one view when every directory is a
+    FeatureStore: returns read(rows) -> dense (len(rows), dim) array, rows in
+    the order given, straight from the memory maps. None for shard
+    directories, where any row read means decoding a whole shard.
+    """
+    parts, offset = [], 0
+    for d in feature_dirs(feature_dir):
+        if not FeatureStore.exists(d):
+            return None
+        store = FeatureStore(d)
+        parts.append((offset, store.open(_resolve_view(d, view))))
+        offset += store.num_rows
+    starts = np.array([start for start, _ in parts])
+
+    def read(rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows)
+        which = np.searchsorted(starts, rows, side='right') - 1
+        out = np.empty((len(rows), parts[0][1].shape[1]), dtype=np.float32)
+        for i, (start, mm) in enumerate(parts):
+            sel = which == i
+            if sel.any():
+                out[sel] = mm[rows[sel] - start]
+        return out
+    return read
+
+
+class StreamingAnova:
+    """
+    One-way ANOVA F-test (as sklearn's f_classif) accumulated chunk by chunk
+    from per-class sufficient statistics: row counts, column sums and column
+    sums of squares. Sums are kept in float64, so scores match f_classif run
+    on the full matrix up to float rounding.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.sums = {}
+        self.sumsq = {}
+
+    def partial_fit(self, X, y: np.ndarray) -> 'StreamingAnova':
+        y = np.asarray(y)
+        for label in np.unique(y):
+            Xc = X[y == label]
+            if sp.issparse(Xc):
+                Xc = Xc.astype(np.float64)
+                s = np.asarray(Xc.sum(axis=0)).ravel()
+                sq = np.asarray(Xc.multiply(Xc).sum(axis=0)).ravel()
+            else:
+                Xc = np.asarray(Xc, dtype=np.float64)
+                s, sq = Xc.sum(axis=0), np.square(Xc).sum(axis=0)
+            if label not in self.counts:
+                self.counts[label], self.sums[label], self.sumsq[label] = 0, 0.0, 0.0
+            self.counts[label] += Xc.shape[0]
+            self.sums[label] = self.sums[label] + s
+            self.sumsq[label] = self.sumsq[label] + sq
+        return self
+
+    def scores(self):
+        """F-statistics and p-values for every column, as returned by f_classif."""
+        labels = sorted(self.counts)
+        n_samples = sum(self.counts.values())
+        ss_alldata = sum(self.sumsq[c] for c in labels)
+        square_of_sums_alldata = sum(self.sums[c] for c in labels) ** 2
+        sstot = ss_alldata - square_of_sums_alldata / n_samples
+        ssbn = sum(self.sums[c] ** 2 / self.counts[c] for c in labels) - square_of_sums_alldata / n_samples
+        # cancellation can leave either sum of squares slightly negative, e.g. for
+        # a column constant within each class, whose F must come out inf, not < 0
+        ssbn = np.maximum(ssbn, 0.0)
+        sswn = np.maximum(sstot - ssbn, 0.0)
+        dfbn, dfwn = len(labels) - 1, n_samples - len(labels)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = (ssbn / dfbn) / (sswn / dfwn)
+        return f, special.fdtrc(dfbn, dfwn, f)
+
+
+def _rank_scores(scores: np.ndarray) -> np.ndarray:
+    # SelectKBest's ordering: NaN scores last, ties broken by a stable sort
+    scores = np.asarray(scores, dtype=np.float64)
+    clean = np.where(np.isnan(scores), np.finfo(scores.dtype).min, scores)
+    return np.argsort(clean, kind='mergesort')[::-1]
+
+
+def rank_anova_streaming(feature_dir: str, view: str = None, rows: np.ndarray = None,
+                         chunk_rows: int = 4096):
+    """
+    rank_anova over a feature directory without loading it: the F-scores
+    are accumulated chunk by chunk over `rows` (default: every row).
+    Returns (order, scores).
+    """
+    anova = StreamingAnova()
+    for X_block, y_block in iter_feature_chunks(feature_dir, view, rows, chunk_rows):
+        anova.partial_fit(X_block, y_block)
+    scores, _ = anova.scores()
+    return _rank_scores(scores), scores
+
+
 def select_anova(X: np.ndarray, y: np.ndarray, k: int = 1000):
     selector = SelectKBest(f_classif, k=k)
     X_new = selector.fit_transform(X, y)
     return X_new, selector
 
 
+def rank_anova(X, y: np.ndarray):
+    """
+    Score every column with f_classif once and rank them best first, with
+    ties and NaN scores (constant columns) broken exactly as SelectKBest does,
+    so order[:k] is the column set SelectKBest(f_classif, k=k) would keep.
+    Returns (order, scores).
+    """
+    scores, _ = f_classif(X, y)
+    return _rank_scores(scores), scores
+
+
 def select_tree(X: np.ndarray, y: np.ndarray, threshold: float = 'median'):
     clf = RandomForestClassifier(n_estimators=100, n_jobs=-1, random_state=42)
     selector = SelectFromModel(clf, threshold=threshold)
     X_new = selector.fit_transform(X, y)
     return X_new, selector
 
+
+def tree_importances_streaming(feature_dir: str, view: str = None, rows: np.ndarray = None,
+                               max_rows: int = None, chunk_rows: int = 4096,
+                               n_estimators: int = 100, random_state: int = 42) -> np.ndarray:
+    """
+    Random-forest feature importances without loading the matrix: the forest
+    is grown chunk by chunk (warm start), each chunk of chunk_rows rows
+    (gathered across shards) adding its share of the n_estimators trees
+    fitted on that chunk alone. `max_rows` first draws a
+    random subsample of the rows, for a quicker, noisier ranking.
+    """
+    if rows is None:
+        rows = np.arange(len(load_labels(feature_dir, view)[0]))
+    if max_rows is not None and len(rows) > max_rows:
+        rows = np.random.default_rng(random_state).choice(rows, max_rows, replace=False)
+    n_chunks = -(-len(rows) // chunk_rows)
+    per_chunk = max(1, round(n_estimators / n_chunks))
+    forest = RandomForestClassifier(n_estimators=per_chunk, n_jobs=-1, random_state=random_state,
+                                    warm_start=True)
+    fitted = False
+    for X_block, y_block in _rebatch(iter_feature_chunks(feature_dir, view, rows, chunk_rows), chunk_rows):
+        if len(np.unique(y_block)) < 2:
+            continue  # a single-class chunk cannot split anything
+        if fitted:
+            forest.n_estimators += per_chunk
+        forest.fit(X_block, y_block)
+        fitted = True
+    if not fitted:
+        raise ValueError(f"No chunk of {feature_dir} holds more than one class")
+    return forest.feature_importances_
+
+
+def select_tree_streaming(feature_dir: str, view: str = None, rows: np.ndarray = None,
+                          threshold='median', **kwargs) -> np.ndarray:
+    """
+    Out-of-core select_tree: indices of the columns whose importance is at
+    least `threshold` ('median', 'mean' or a number), as SelectFromModel keeps.
+    """
+    importances = tree_importances_streaming(feature_dir, view, rows, **kwargs)
+    if threshold == 'median':
+        threshold = np.median(importances)
+    elif threshold == 'mean':
+        threshold = np.mean(importances)
+    return np.flatnonzero(importances >= threshold)
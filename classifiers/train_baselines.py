@@ -1,23 +1,221 @@
 import os
+import copy
+import inspect
 import argparse
 import numpy as np
+import scipy.sparse as sp
 from sklearn.model_selection import train_test_split
 from sklearn.neural_network import MLPClassifier
-from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.ensemble import GradientBoostingClassifier, HistGradientBoostingClassifier
 from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import log_loss
 
-from feature_selection import load_features
+from feature_selection import load_features, load_labels, load_rows, row_reader, iter_feature_chunks, _rebatch
+import profiling
+from profiling import stage
 
 
 def train_and_save(clf, X_train, y_train, X_test, out_path):
-    clf.fit(X_train, y_train)
-    proba = clf.predict_proba(X_test)[:, 1]
+    with stage(f'fit.{type(clf).__name__}'):
+        clf.fit(X_train, y_train)
+    with stage('predict'):
+        proba = clf.predict_proba(X_test)[:, 1]
     np.save(out_path, proba)
     print(f"Saved predictions to {out_path}")
 
 
+def fit_boosting(X_fit, y_fit, X_val, y_val, n_estimators: int = 100, patience: int = 10):
+    """
+    Histogram-binned, multi-threaded gradient boosting with early stopping
+    on (X_val, y_val): XGBoost's hist method when xgboost is installed
+    (sparse input used as is), otherwise sklearn's HistGradientBoosting,
+    which needs dense input and refuses sparse input rather than densify it.
+    """
+    try:
+        from xgboost import XGBClassifier
+    except ImportError:
+        XGBClassifier = None
+    if XGBClassifier is not None:
+        clf = XGBClassifier(n_estimators=n_estimators, tree_method='hist', n_jobs=-1, random_state=42,
+                            early_stopping_rounds=patience, eval_metric='logloss')
+        clf.fit(X_fit, y_fit, eval_set=[(X_val, y_val)], verbose=False)
+        return clf
+    if sp.issparse(X_fit) or sp.issparse(X_val):
+        raise ValueError("Boosting on sparse features needs xgboost (pip install xgboost); "
+                         "HistGradientBoosting would densify every column")
+    clf = HistGradientBoostingClassifier(max_iter=n_estimators, early_stopping=True,
+                                         n_iter_no_change=patience, random_state=42)
+    if 'X_val' in inspect.signature(clf.fit).parameters:
+        clf.fit(X_fit, y_fit, X_val=X_val, y_val=y_val)
+    else:
+        # older sklearn: hand over fit + validation rows and let it split off the same share
+        clf.validation_fraction = len(y_val) / (len(y_fit) + len(y_val))
+        clf.fit(np.vstack([X_fit, X_val]), np.concatenate([y_fit, y_val]))
+    return clf
+
+
+class _BoosterClassifier:
+    """predict_proba over a binary:logistic xgboost Booster, up to its best iteration."""
+    def __init__(self, booster):
+        self.booster = booster
+
+    def predict_proba(self, X) -> np.ndarray:
+        import xgboost
+        proba = self.booster.predict(xgboost.DMatrix(X), iteration_range=(0, self.booster.best_iteration + 1))
+        return np.column_stack([1 - proba, proba])
+
+
+def fit_boosting_streaming(feature_dir: str, view: str, fit_rows: np.ndarray, y_fit: np.ndarray, X_val, y_val,
+                           memory_gb: float = 4.0, n_estimators: int = 100, patience: int = 10,
+                           chunk_rows: int = 4096):
+    """
+    fit_boosting over fit_rows without holding them in memory: with xgboost,
+    chunk_rows batches of the rows are streamed into a QuantileDMatrix, which
+    keeps only the binned (and, for sparse shards, sparse) values. Without
+    xgboost the rows are loaded for HistGradientBoosting, and refused when
+    they exceed memory_gb.
+    """
+    try:
+        import xgboost
+    except ImportError:
+        xgboost = None
+    if xgboost is None:
+        if len(fit_rows) * _row_bytes(X_val) > memory_gb * 2**30:
+            raise ValueError(f"The fit rows of {feature_dir} exceed {memory_gb} GB; boosting on them "
+                             f"without loading them needs xgboost (pip install xgboost)")
+        with stage('load'):
+            X_fit = load_rows(feature_dir, view, fit_rows)
+        return fit_boosting(X_fit, y_fit, X_val, y_val, n_estimators, patience)
+
+    class Batches(xgboost.DataIter):
+        def __init__(self):
+            self.blocks = None
+            super().__init__()
+
+        def next(self, input_data) -> bool:
+            if self.blocks is None:
+                self.blocks = _rebatch(iter_feature_chunks(feature_dir, view, fit_rows, chunk_rows), chunk_rows)
+            block = next(self.blocks, None)
+            if block is None:
+                return False
+            input_data(data=block[0], label=block[1])
+            return True
+
+        def reset(self):
+            self.blocks = None
+
+    d_fit = xgboost.QuantileDMatrix(Batches())
+    d_val = xgboost.QuantileDMatrix(X_val, y_val, ref=d_fit)
+    params = dict(objective='binary:logistic', tree_method='hist', eval_metric='logloss', seed=42)
+    booster = xgboost.train(params, d_fit, num_boost_round=n_estimators, evals=[(d_val, 'val')],
+                            early_stopping_rounds=patience, verbose_eval=False)
+    return _BoosterClassifier(booster)
+
+
+def _row_bytes(X) -> float:
+    """Approximate in-memory size of one row of X."""
+    if sp.issparse(X):
+        return X.nnz / max(1, X.shape[0]) * (X.dtype.itemsize + 4) + 8
+    return X.shape[1] * np.dtype(X.dtype).itemsize
+
+
+def fit_mlp_streaming(feature_dir: str, view: str, fit_rows: np.ndarray, y_fit: np.ndarray, X_val, y_val,
+                      X_fit=None, memory_gb: float = 4.0, max_epochs: int = 500, patience: int = 10,
+                      chunk_rows: int = 4096, batch_size: int = 200) -> MLPClassifier:
+    """
+    The baseline MLP trained with mini-batch partial_fit, every epoch over a
+    fresh shuffle of all fit_rows. The rows are read once (or taken from
+    X_fit) when they fit in memory_gb; otherwise each chunk_rows slice of the
+    shuffle is read from the memory-mapped FeatureStore, which must then hold
+    the features. Stops once the validation log-loss has not improved for
+    `patience` epochs and returns the best epoch's model.
+    """
+    read = None
+    if X_fit is None:
+        if len(fit_rows) * _row_bytes(X_val) <= memory_gb * 2**30:
+            X_fit = load_rows(feature_dir, view, fit_rows)
+        else:
+            read = row_reader(feature_dir, view)
+            if read is None:
+                raise ValueError(f"The fit rows of {feature_dir} exceed {memory_gb} GB; streaming them "
+                                 f"needs memmap features (run_sae --format memmap) or a larger budget")
+    mlp = MLPClassifier(hidden_layer_sizes=(100,), random_state=42)
+    classes = np.unique(y_val)
+    rng = np.random.default_rng(42)
+    best, best_loss, stale = None, np.inf, 0
+    for _ in range(max_epochs):
+        perm = rng.permutation(len(fit_rows))
+        for chunk_start in range(0, len(perm), chunk_rows):
+            pos = perm[chunk_start:chunk_start + chunk_rows]
+            X_chunk = X_fit[pos] if read is None else read(fit_rows[pos])
+            y_chunk = y_fit[pos]
+            for start in range(0, len(pos), batch_size):
+                mlp.partial_fit(X_chunk[start:start + batch_size], y_chunk[start:start + batch_size],
+                                classes=classes)
+        loss = log_loss(y_val, mlp.predict_proba(X_val), labels=classes)
+        if np.isfinite(loss) and loss < best_loss - 1e-4:
+            best, best_loss, stale = copy.deepcopy(mlp), loss, 0
+        else:
+            stale += 1
+            if stale >= patience:
+                break
+    if best is None:
+        print("Warning: the MLP's validation loss was never finite; keeping its last epoch")
+        return mlp
+    return best
+
+
+def save_proba(clf, X_test, out_path):
+    with stage('predict'):
+        proba = clf.predict_proba(X_test)[:, 1]
+    np.save(out_path, proba)
+    print(f"Saved predictions to {out_path}")
+
+
+def main_fast(args):
+    """
+    Same splits and output files as main(), with fit_boosting_streaming in
+    place of GradientBoostingClassifier and fit_mlp_streaming in place of the
+    in-memory MLP. A validation share of the training rows drives early
+    stopping; the fit rows are only loaded when they fit in --memory-gb.
+    """
+    y, ids = load_labels(args.feature_dir, view=args.view)
+    # splitting row indices gives the same split as splitting X in main()
+    train_idx, test_idx, y_train, y_test = train_test_split(
+        np.arange(len(y)), y, test_size=args.test_size, random_state=42, stratify=y
+    )
+    fit_idx, val_idx, y_fit, y_val = train_test_split(
+        train_idx, y_train, test_size=args.validation_fraction, random_state=42, stratify=y_train
+    )
+    with stage('load'):
+        X_test = load_rows(args.feature_dir, args.view, test_idx)
+        X_val = load_rows(args.feature_dir, args.view, val_idx)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    for kind in ('sae', 'cls'):
+        if kind not in args.feature_dir:
+            continue
+        with stage('fit.mlp_streaming'):
+            mlp = fit_mlp_streaming(args.feature_dir, args.view, fit_idx, y_fit, X_val, y_val,
+                                    memory_gb=args.memory_gb)
+        save_proba(mlp, X_test, os.path.join(args.out_dir, f'proba_{kind}_baseline_mlp.npy'))
+        if kind == 'sae':
+            with stage('fit.boosting'):
+                xgb = fit_boosting_streaming(args.feature_dir, args.view, fit_idx, y_fit, X_val, y_val,
+                                             memory_gb=args.memory_gb)
+            save_proba(xgb, X_test, os.path.join(args.out_dir, 'proba_sae_baseline_xgb.npy'))
+        else:
+            with stage('load'):
+                X_train = load_rows(args.feature_dir, args.view, train_idx)
+            lr = LogisticRegression(max_iter=1000)
+            train_and_save(lr, X_train, y_train, X_test, os.path.join(args.out_dir, 'proba_cls_baseline_lr.npy'))
+
+
 def main(args):
-    X, y, ids = load_features(args.feature_dir)
+    if args.engine == 'fast':
+        return main_fast(args)
+    with stage('load'):
+        X, y, ids = load_features(args.feature_dir, view=args.view)
     X_train, X_test, y_train, y_test = train_test_split(
         X, y, test_size=args.test_size, random_state=42, stratify=y
     )
@@ -46,5 +244,17 @@ if __name__ == '__main__':
     parser.add_argument('--feature-dir', required=True)
     parser.add_argument('--out-dir', required=True)
     parser.add_argument('--test-size', type=float, default=0.2)
+    parser.add_argument('--view', default=None,
+                        help="Feature view to train on, e.g. 'mean_layer20' or 'mean'")
+    parser.add_argument('--engine', default='sklearn', choices=['sklearn', 'fast'],
+                        help="'fast': histogram boosting (XGBoost if installed) and a streamed "
+                             "mini-batch MLP, both with early stopping")
+    parser.add_argument('--validation-fraction', type=float, default=0.1,
+                        help='Share of the training rows held out for early stopping (fast engine)')
+    parser.add_argument('--memory-gb', type=float, default=4.0,
+                        help='Fast engine: training rows above this size are streamed (the MLP from '
+                             'a memmap feature store) instead of loaded')
+    profiling.add_profile_arg(parser, 'baselines_run_report.json/.csv in --out-dir')
     args = parser.parse_args()
-    main(args)
+    with profiling.profiled(args.profile, args.out_dir, 'baselines_run_report', vars(args)):
+        main(args)
@@ -2,11 +2,14 @@ import os
 import argparse
 import numpy as np
 import pandas as pd
-from sklearn.feature_selection import SelectKBest, f_classif
+from joblib import Parallel, delayed
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
 
-from feature_selection import load_features
+from feature_selection import load_features, load_labels, rank_anova, rank_anova_streaming
+from scoring import ScoringModel
+import profiling
+from profiling import stage, count
 
 # Define K values per SAE variant
 K_VALUES = {
@@ -15,31 +18,81 @@ K_VALUES = {
 }
 
 
+def fit_path(X_train, y_train, X_test, ks: list, warm_start: bool = True) -> list:
+    """
+    Fit one LogisticRegression per k along a path of nested feature sets:
+    the columns of X_train/X_test are already in rank order, so the top-k
+    set is the first k columns. Each fit starts from the previous solution,
+    padded with zeros for the k - k_prev newly added features.
+    Returns (test-set probabilities, fitted classifier) for each k.
+    """
+    fits, prev = [], None
+    for k in ks:
+        clf = LogisticRegression(max_iter=1000, warm_start=warm_start)
+        if warm_start and prev is not None:
+            clf.coef_ = np.pad(prev.coef_, ((0, 0), (0, k - prev.coef_.shape[1])))
+            clf.intercept_ = prev.intercept_.copy()
+        with stage(f'fit.k{k}'):
+            clf.fit(X_train[:, :k], y_train)
+        fits.append((clf.predict_proba(X_test[:, :k])[:, 1], clf))
+        prev = clf
+    return fits
+
+
 def main(args):
-    X, y, ids = load_features(args.feature_dir)
     sae_id = os.path.basename(os.path.normpath(args.feature_dir))
     ks = K_VALUES.get(sae_id)
     if ks is None:
         raise ValueError(f"Unknown SAE variant '{sae_id}' for FS.")
+    if args.export_k is not None and (args.export_k not in ks or args.view is None):
+        raise ValueError(f"--export-k needs --view and one of the k values {ks}")
 
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=args.test_size, random_state=42, stratify=y
-    )
+    if args.streaming:
+        # rank on the training rows chunk by chunk, then load only the top columns;
+        # splitting row indices gives the same split as splitting X itself
+        y, ids = load_labels(args.feature_dir, view=args.view)
+        train_idx, test_idx, y_train, y_test = train_test_split(
+            np.arange(len(y)), y, test_size=args.test_size, random_state=42, stratify=y
+        )
+        with stage('rank'):
+            order, _ = rank_anova_streaming(args.feature_dir, view=args.view, rows=train_idx)
+        with stage('load'):
+            X, _, _ = load_features(args.feature_dir, view=args.view, cols=order[:max(ks)])
+        X_train, X_test = X[train_idx], X[test_idx]
+    else:
+        with stage('load'):
+            X, y, ids = load_features(args.feature_dir, view=args.view)
+        X_train, X_test, y_train, y_test = train_test_split(
+            X, y, test_size=args.test_size, random_state=42, stratify=y
+        )
+        # score and rank the features once; every k takes a prefix of the ranking
+        with stage('rank'):
+            order, _ = rank_anova(X_train, y_train)
+        top = order[:max(ks)]
+        X_train, X_test = X_train[:, top], X_test[:, top]
+    count('rows', len(y))
+
+    ks = sorted(ks)
+    # each worker runs a warm-started path over a contiguous run of k values
+    segments = [[int(k) for k in seg] for seg in np.array_split(ks, min(args.jobs, len(ks)))]
+    with stage('fit'):
+        paths = Parallel(n_jobs=len(segments), prefer='threads')(
+            delayed(fit_path)(X_train, y_train, X_test, seg, not args.no_warm_start) for seg in segments
+        )
 
     os.makedirs(args.out_dir, exist_ok=True)
     results = []
-    for k in ks:
-        selector = SelectKBest(f_classif, k=k)
-        X_train_sel = selector.fit_transform(X_train, y_train)
-        X_test_sel = selector.transform(X_test)
-        clf = LogisticRegression(max_iter=1000)
-        clf.fit(X_train_sel, y_train)
-        proba = clf.predict_proba(X_test_sel)[:, 1]
+    for k, (proba, clf) in zip(ks, [fit for path in paths for fit in path]):
         fname = f"proba_sae_fs_{sae_id}_k{k}_lr.npy"
         out_path = os.path.join(args.out_dir, fname)
         np.save(out_path, proba)
         results.append((k, out_path))
         print(f"Saved predictions for k={k} to {out_path}")
+        if k == args.export_k:
+            # classifier columns are the top-k latents in rank order
+            model_path = os.path.join(args.out_dir, f"model_sae_fs_{sae_id}_k{k}.joblib")
+            ScoringModel(sae_id, args.view, order[:k], clf).save(model_path)
+            print(f"Exported scoring model for k={k} to {model_path}")
 
     summary = pd.DataFrame(results, columns=['k','proba_path'])
     summary.to_csv(os.path.join(args.out_dir, 'fs_summary.csv'), index=False)
@@ -50,5 +103,17 @@ if __name__ == '__main__':
     parser.add_argument('--feature-dir', required=True, help='Directory of SAE features')
     parser.add_argument('--out-dir', required=True, help='Output directory for predictions')
     parser.add_argument('--test-size', type=float, default=0.2)
+    parser.add_argument('--view', default=None,
+                        help="Feature view to train on, e.g. 'mean_layer20' or 'mean'")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Split the k path into this many warm-started runs fitted in parallel')
+    parser.add_argument('--no-warm-start', action='store_true',
+                        help='Fit every k from scratch, as independent models')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Rank features chunk by chunk and load only the selected columns')
+    parser.add_argument('--export-k', type=int, default=None,
+                        help='Save the selected latents and classifier for this k, for scoring new transcripts')
+    profiling.add_profile_arg(parser, 'fs_run_report.json/.csv in --out-dir')
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    with profiling.profiled(args.profile, args.out_dir, 'fs_run_report', vars(args)):
+        main(args)
\ No newline at end of file
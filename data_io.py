@@ -1,27 +1,170 @@
+import os
 import json
 import pandas as pd
-from typing import Dict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+class TranscriptIndex:
+    """
+    Byte-offset index over a component JSONL file: transcript ids in order of
+    first appearance, each with the (start, end) byte spans of its lines.
+    Saved next to the JSONL as <file>.idx.json and rebuilt when the JSONL's
+    size or mtime changes.
+    """
+    def __init__(self, ids: List[str], spans: List[List[Tuple[int, int]]]):
+        self.ids = ids
+        self.spans = spans
+
+    @staticmethod
+    def _stamp(jsonl_path: str) -> dict:
+        st = os.stat(jsonl_path)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    @classmethod
+    def build(cls, jsonl_path: str) -> 'TranscriptIndex':
+        order, spans = [], {}
+        last_tid = None
+        with open(jsonl_path, 'rb') as f:
+            offset = 0
+            for line in f:
+                end = offset + len(line)
+                if line.strip():
+                    tid = json.loads(line)['transcript_id']
+                    if tid not in spans:
+                        order.append(tid)
+                        spans[tid] = []
+                    if tid == last_tid:
+                        spans[tid][-1][1] = end  # extend the current run of lines
+                    else:
+                        spans[tid].append([offset, end])
+                    last_tid = tid
+                offset = end
+        return cls(order, [spans[tid] for tid in order])
+
+    @classmethod
+    def load_or_build(cls, jsonl_path: str) -> 'TranscriptIndex':
+        idx_path = jsonl_path + '.idx.json'
+        stamp = cls._stamp(jsonl_path)
+        if os.path.exists(idx_path):
+            with open(idx_path, 'r') as f:
+                data = json.load(f)
+            if data.get('source') == stamp:
+                return cls(data['ids'], data['spans'])
+        index = cls.build(jsonl_path)
+        try:
+            tmp = idx_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'source': stamp, 'ids': index.ids, 'spans': index.spans}, f)
+            os.replace(tmp, idx_path)
+        except OSError:
+            pass  # read-only data directory: keep the index in memory only
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def _join_components(parts: List[str]) -> str:
+    # same text as the old `comps[tid] + ' ' + text` accumulation, in linear time
+    return ''.join(' ' + part for part in parts)
+
 
 class TranscriptDataset:
     """
     Loads transcript component texts from JSONL and metadata from CSV.
+    Transcripts are read lazily through a byte-offset index, so a caller (or a
+    worker process) can seek straight to a slice without parsing the rest.
     """
-    def __init__(self, jsonl_path: str, meta_csv_path: str):
+    def __init__(self, jsonl_path: str, meta_csv_path: str, use_index: bool = True):
         self.jsonl_path = jsonl_path
         self.meta_csv_path = meta_csv_path
+        self.use_index = use_index
+        self._index = None
+        self._meta = None
+
+    def index(self) -> TranscriptIndex:
+        if self._index is None:
+            self._index = TranscriptIndex.load_or_build(self.jsonl_path)
+        return self._index
+
+    def transcript_ids(self) -> List[str]:
+        return self.index().ids
+
+    def __len__(self) -> int:
+        return len(self.index())
+
+    def __getstate__(self):
+        # worker processes re-load the (cheap) index and metadata themselves
+        state = self.__dict__.copy()
+        state['_index'] = None
+        state['_meta'] = None
+        return state
+
+    def load_range(self, start: int = 0, stop: int = None) -> List[Tuple[str, str]]:
+        """(transcript_id, text) for transcripts start..stop-1 in file order."""
+        index = self.index()
+        out = []
+        with open(self.jsonl_path, 'rb') as f:
+            for tid, spans in zip(index.ids[start:stop], index.spans[start:stop]):
+                parts = []
+                for s, e in spans:
+                    f.seek(s)
+                    for line in f.read(e - s).splitlines():
+                        if line.strip():
+                            parts.append(json.loads(line).get('component_text', ''))
+                out.append((tid, _join_components(parts)))
+        return out
+
+    def _stream(self) -> Iterator[Tuple[str, str]]:
+        """One pass over the JSONL without an index; components must be contiguous."""
+        seen = set()
+        tid, parts = None, []
+        with open(self.jsonl_path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                obj = json.loads(line)
+                if obj['transcript_id'] != tid:
+                    if tid is not None:
+                        yield tid, _join_components(parts)
+                    tid, parts = obj['transcript_id'], []
+                    if tid in seen:
+                        raise ValueError(f"Components of {tid} are not contiguous in "
+                                         f"{self.jsonl_path}; use the index (use_index=True)")
+                    seen.add(tid)
+                parts.append(obj.get('component_text', ''))
+        if tid is not None:
+            yield tid, _join_components(parts)
+
+    def iter_transcripts(self, start: int = 0, stop: int = None,
+                         chunk_size: int = 256) -> Iterator[Tuple[str, str, Optional[pd.Series]]]:
+        """
+        Lazily yield (transcript_id, text, metadata_row) in file order;
+        metadata_row is None for transcripts missing from the metadata CSV.
+        """
+        meta = self.metadata()
+        if not self.use_index:
+            for i, (tid, text) in enumerate(self._stream()):
+                if i >= start and (stop is None or i < stop):
+                    yield tid, text, meta.loc[tid] if tid in meta.index else None
+            return
+        stop = len(self) if stop is None else min(stop, len(self))
+        for lo in range(start, stop, chunk_size):
+            for tid, text in self.load_range(lo, min(lo + chunk_size, stop)):
+                yield tid, text, meta.loc[tid] if tid in meta.index else None
 
     def load_components(self) -> Dict[str, str]:
         """
         Returns a dict mapping transcript_id to concatenated component text.
         """
-        comps = {}
-        with open(self.jsonl_path, 'r') as f:
-            for line in f:
-                obj = json.loads(line)
-                tid = obj['transcript_id']
-                text = obj.get('component_text', '')
-                comps[tid] = comps.get(tid, '') + ' ' + text
-        return comps
+        if self.use_index:
+            return dict(self.load_range())
+        return dict(self._stream())
+
+    def metadata(self) -> pd.DataFrame:
+        """load_metadata(), read once and kept for lookups."""
+        if self._meta is None:
+            self._meta = self.load_metadata()
+        return self._meta
 
     def load_metadata(self) -> pd.DataFrame:
         """
@@ -29,4 +172,4 @@ class TranscriptDataset:
         """
         df = pd.read_csv(self.meta_csv_path)
         df = df.set_index('transcript_id')
-        return df
\ No newline at end of file
+        return df
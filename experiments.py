@@ -1,46 +1,504 @@
 import os
+import json
+import glob
+import shutil
+import threading
 import numpy as np
 import pandas as pd
-from typing import Any
+import scipy.sparse as sp
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Callable, List, Tuple
+from feature_store import FeatureStore
+from activation_cache import ActivationCache
+import profiling
+from profiling import stage, count
+
+SHARD_FORMATS = ('dense', 'csr', 'memmap')
+
+def _atomic_write(path: str, write: Callable):
+    """Write via a temp file and rename, so `path` is either absent or complete."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+def check_window(window: int, overlap: int):
+    """
+    Refuse a sliding-window setting split_windows cannot walk: each window
+    (less a re-prepended BOS) must advance past its `overlap` context tokens.
+    """
+    if window is not None and not 0 <= overlap < window - 1:
+        raise ValueError(f"Window overlap must be in [0, {window - 1}) for windows of {window} tokens, "
+                         f"got {overlap}")
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class ShardManifest:
+    """
+    Records which flush chunks of a run are fully on disk, so an interrupted
+    run can skip them on restart. Entries are keyed by chunk index and hold
+    the chunk's first/last transcript id plus either the shard files written
+    (with their sizes) or, for a FeatureStore, the row range appended. A
+    directory written with a different config (chunking, format, layers, ...)
+    is refused with a ValueError, unless `overwrite` lets the run delete the
+    old manifest and its shards and start over.
+
+    Worker processes sharing an output directory each write their own
+    manifest.part<N>.json; every manifest with the current config is merged
+    on load, and consolidate() folds the parts back into manifest.json.
+
+    A read_only manifest only inspects: manifests from other configs are
+    ignored rather than deleted with their shards, and nothing is saved.
+    """
+    FILENAME = 'manifest.json'
+
+    def __init__(self, output_dir: str, config: dict, part: int = None, read_only: bool = False,
+                 overwrite: bool = False):
+        self.output_dir = output_dir
+        self.read_only = read_only
+        name = self.FILENAME if part is None else f"manifest.part{part}.json"
+        self.path = os.path.join(output_dir, name)
+        self.config = config
+        self.chunks = {}
+        stale = []
+        for path in self._manifest_paths():
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('config') == config:
+                self.chunks.update(data['chunks'])
+            else:
+                stale.append((path, data))
+        self.fresh = len(stale) == len(self._manifest_paths())
+        if stale and not read_only:
+            if not overwrite:
+                raise ValueError(f"{output_dir} holds a run with config {stale[0][1].get('config')}, "
+                                 f"not {config}; pass overwrite (--overwrite) to delete it and start over")
+            for path, data in stale:
+                self._discard(path, data['chunks'])
+
+    def _manifest_paths(self) -> List[str]:
+        main = os.path.join(self.output_dir, self.FILENAME)
+        parts = sorted(glob.glob(os.path.join(self.output_dir, 'manifest.part*.json')))
+        return ([main] if os.path.exists(main) else []) + parts
+
+    def _discard(self, path: str, chunks: dict):
+        """Delete a manifest written under a different config, and its shard files."""
+        for entry in chunks.values():
+            for fname in entry.get('files', {}):
+                _remove(os.path.join(self.output_dir, fname))
+        _remove(path)
+
+    def _save(self):
+        if self.read_only:
+            raise RuntimeError(f"Manifest of {self.output_dir} was opened read-only")
+        payload = json.dumps({'config': self.config, 'chunks': self.chunks}, indent=2)
+        _atomic_write(self.path, lambda f: f.write(payload.encode('utf-8')))
+
+    def consolidate(self):
+        """Write every merged entry to manifest.json and drop the per-worker parts."""
+        self.path = os.path.join(self.output_dir, self.FILENAME)
+        self._save()
+        for path in glob.glob(os.path.join(self.output_dir, 'manifest.part*.json')):
+            _remove(path)
+
+    def _matches(self, k: int, ids: list) -> bool:
+        entry = self.chunks.get(str(k))
+        return entry is not None and entry['first'] == ids[0] and entry['last'] == ids[-1] \
+            and entry['size'] == len(ids)
+
+    def is_done(self, k: int, ids: list) -> bool:
+        """True if chunk k covers the same ids and all of its shard files are intact."""
+        if not self._matches(k, ids):
+            return False
+        for fname, size in self.chunks[str(k)].get('files', {}).items():
+            path = os.path.join(self.output_dir, fname)
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                return False
+        return True
+
+    def store_prefix(self, chunks: List[Tuple[int, list]], committed_rows: int) -> int:
+        """
+        Number of leading (index, ids) chunks whose rows are committed to the
+        FeatureStore. Entries past that prefix are forgotten, since their rows
+        will be rewritten.
+        """
+        done = 0
+        for k, ids in chunks:
+            if not self._matches(k, ids) or self.chunks[str(k)]['rows'][1] > committed_rows:
+                break
+            done += 1
+        keep = {str(k) for k, _ in chunks[:done]}
+        self.chunks = {key: v for key, v in self.chunks.items() if key in keep}
+        self._save()
+        return done
+
+    def mark_done(self, k: int, ids: list, entry: dict):
+        self.chunks[str(k)] = dict(first=ids[0], last=ids[-1], size=len(ids), **entry)
+        self._save()
 
 class BaseExperiment:
-    def __init__(self, extractor: Any, dataset: Any, output_dir: str, flush_every: int = 100):
+    def __init__(self, extractor: Any, dataset: Any, output_dir: str, flush_every: int = 100,
+                 batch_size: int = 1, max_tokens: int = None, window: int = None,
+                 window_overlap: int = 0, fmt: str = 'dense', prefetch: int = 2,
+                 tokenize_workers: int = 1, pending_writes: int = 2, tokens: Any = None,
+                 profile: str = None, report_dir: str = None, overwrite: bool = False):
+        if fmt not in SHARD_FORMATS:
+            raise ValueError(f"Unknown shard format '{fmt}', expected one of {SHARD_FORMATS}")
+        check_window(window, window_overlap)
         self.ext = extractor
         self.ds = dataset
         self.output_dir = output_dir
         os.makedirs(output_dir, exist_ok=True)
         self.flush_every = flush_every
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.window = window
+        self.window_overlap = window_overlap
+        self.fmt = fmt
+        self.store = FeatureStore(output_dir) if fmt == 'memmap' else None
+        # pipeline depth: chunks tokenized ahead / encoded chunks awaiting the writer
+        self.prefetch = max(1, prefetch)
+        self.tokenize_workers = tokenize_workers
+        self.pending_writes = pending_writes
+        # optional TokenStore of this dataset: token ids are read instead of tokenized
+        self.tokens = tokens
+        # None, 'stages' or 'cprofile': what run() records into its run report
+        if profile is not None and profile not in profiling.MODES:
+            raise ValueError(f"Unknown profile mode '{profile}', expected one of {profiling.MODES}")
+        self.profile = profile
+        self.report_dir = output_dir if report_dir is None else report_dir
+        # whether a run may delete outputs written under a different config
+        self.overwrite = overwrite
+
+    def _config(self, layers: list) -> dict:
+        """Settings that change shard contents or boundaries; see ShardManifest."""
+        return {
+            'model': getattr(self.ext, 'hf_model', None),
+            'sae': getattr(self.ext, 'sae_checkpoint', None),
+            'layers': layers,
+            'flush_every': self.flush_every,
+            'window': self.window,
+            'window_overlap': self.window_overlap if self.window is not None else None,
+            'fmt': self.fmt,
+        }
+
+    def _layers(self) -> list:
+        # for SAE, all configured layers come out of one forward pass; for CLS, only one
+        return getattr(self.ext, 'layers', [None])
+
+    def _chunks(self) -> List[list]:
+        """Transcript ids of each flush chunk, in dataset order."""
+        ids = self.ds.transcript_ids()
+        return [ids[start:start + self.flush_every] for start in range(0, len(ids), self.flush_every)]
+
+    def _load_chunk(self, k: int) -> List[str]:
+        """Texts of flush chunk k, read straight from its slice of the dataset."""
+        start = k * self.flush_every
+        return [txt for _, txt in self.ds.load_range(start, start + self.flush_every)]
 
-    def run(self):
-        texts = self.ds.load_components()
+    def _stored_tokens(self, k: int, texts: List[str], truncation: bool) -> List[List[int]]:
+        """Token ids of flush chunk k from the TokenStore, after checking its texts are unchanged."""
+        start = k * self.flush_every
+        if self.tokens.text_hashes(start, start + len(texts)) != [ActivationCache.text_hash(t) for t in texts]:
+            raise ValueError(f"Token store {self.tokens.root} does not match the texts of chunk {k}; rebuild it")
+        max_length = self.ext.tokenizer.model_max_length if truncation else None
+        return self.tokens.seqs(start, start + len(texts), max_length)
+
+    def is_complete(self) -> bool:
+        """
+        True if every flush chunk is already on disk under the current config
+        and the index is written, so run() has nothing to do. Reads only the
+        extractor's identity attributes, so no model needs to be loaded, and
+        never modifies the output directory, whatever config it was written with.
+        """
+        if not os.path.exists(os.path.join(self.output_dir, 'index.csv')):
+            return False
+        chunk_ids = self._chunks()
+        manifest = ShardManifest(self.output_dir, self._config(self._layers()), read_only=True)
+        if self.store is not None:
+            return all(manifest._matches(k, ids) and manifest.chunks[str(k)]['rows'][1] <= self.store.num_rows
+                       for k, ids in enumerate(chunk_ids))
+        return all(manifest.is_done(k, ids) for k, ids in enumerate(chunk_ids))
+
+    def run(self, only: List[int] = None, part: int = None, report_name: str = None):
+        """
+        Extract every flush chunk not already recorded as done. `only`
+        restricts the run to some chunk indices (contiguous for the memmap
+        format) and `part` names this process's manifest when several workers
+        share the output directory; see run_parallel. With profiling on, the
+        stage timings, counters and memory peaks of the run are written to
+        report_dir as <report_name>.json/.csv (default run_report[.part<N>]).
+        """
+        if report_name is None:
+            report_name = 'run_report' if part is None else f"run_report.part{part}"
+        info = {}
+        if self.profile:
+            info = dict(self._config(self._layers()), output_dir=self.output_dir,
+                        chunks=None if only is None else len(only), batch_size=self.batch_size,
+                        max_tokens=self.max_tokens, device=str(getattr(self.ext, 'device', None)))
+        with profiling.profiled(self.profile, self.report_dir, report_name, info):
+            self._run(only, part)
+
+    def _run(self, only: List[int] = None, part: int = None):
         meta = self.ds.load_metadata()
-        # for SAE, loop over configured layers; for CLS, only one
-        for layer in getattr(self.ext, 'layers', [None]):
-            buffers = {}
-            ids = []
-            for idx, (tid, txt) in enumerate(texts.items(), start=1):
-                acts = self.ext.encode(txt, layer) if layer is not None else self.ext.encode(txt)
-                feats = self.ext.stats(acts)
-                for name, vec in feats.items():
-                    buffers.setdefault(name, []).append(vec)
-                ids.append(tid)
-                if idx % self.flush_every == 0:
-                    self._flush(buffers, ids, meta, layer)
-                    buffers, ids = {}, []
-            if ids:
-                self._flush(buffers, ids, meta, layer)
-
-    def _flush(self, buffers: dict, ids: list, meta: pd.DataFrame, layer: int = None):
-        layer_suffix = f"_layer{layer}" if layer is not None else ''
+        layers = self._layers()
+        chunk_ids = self._chunks()
+        if self.tokens is not None:
+            self.tokens.check(self.ds, self.ext.tokenizer)
+        todo = list(range(len(chunk_ids))) if only is None else list(only)
+        config = self._config(layers)
+        if self.store is not None and only is not None:
+            # a store holds exactly one contiguous run of chunks
+            config['chunks'] = [todo[0], todo[-1]] if todo else []
+        manifest = ShardManifest(self.output_dir, config, part=part, overwrite=self.overwrite)
+        if self.store is not None:
+            if manifest.fresh:
+                self.store.reset()
+            done = manifest.store_prefix([(k, chunk_ids[k]) for k in todo], self.store.num_rows)
+            self.store.truncate(sum(len(chunk_ids[k]) for k in todo[:done]))
+            todo = todo[done:]
+        else:
+            todo = [k for k in todo if not manifest.is_done(k, chunk_ids[k])]
+        self._pipeline(todo, chunk_ids, layers, meta, manifest)
+        if only is None:
+            self._write_index(chunk_ids, meta)
+
+    def _pipeline(self, todo: List[int], chunk_ids: List[list], layers: list,
+                  meta: pd.DataFrame, manifest: ShardManifest):
+        """
+        Three overlapped stages over the flush chunks in `todo`: a thread pool
+        reads and tokenizes up to `prefetch` chunks ahead, this thread runs the model,
+        and a single writer thread flushes finished chunks in order. Both
+        queues are bounded, so memory stays capped when one stage lags. Once
+        a flush fails nothing after it is written or committed: queued writes
+        are skipped, no further chunks are encoded, and the error is raised.
+        """
+        truncation = self.window is None
+        tokenizer_pool = ThreadPoolExecutor(self.tokenize_workers)
+        writer = ThreadPoolExecutor(1)
+        tokenized, writes = deque(), deque()
+        upcoming = iter(todo)
+        failed = threading.Event()
+
+        def write(k: int, buffers: dict):
+            if failed.is_set():
+                return  # an earlier chunk failed; later ones must not land after it
+            try:
+                self._write_chunk(manifest, k, buffers, chunk_ids[k], meta)
+            except BaseException:
+                failed.set()
+                raise
+
+        def load_and_tokenize(k: int):
+            with stage('read'):
+                texts = self._load_chunk(k)
+            if self.tokens is not None:
+                with stage('token_store'):
+                    return texts, self._stored_tokens(k, texts, truncation)
+            with stage('tokenize'):
+                return texts, self.ext.tokenize(texts, truncation)
+
+        def tokenize_next():
+            k = next(upcoming, None)
+            if k is not None:
+                tokenized.append((k, tokenizer_pool.submit(load_and_tokenize, k)))
+
+        try:
+            for _ in range(self.prefetch):
+                tokenize_next()
+            # each flush chunk is encoded as a unit so it can be length-bucketed
+            while tokenized and not failed.is_set():
+                k, future = tokenized.popleft()
+                # waits show up as stalls of the model on the other two stages
+                with stage('wait_tokenize'):
+                    texts, seqs = future.result()
+                tokenize_next()
+                buffers = {layer: {} for layer in layers}
+                with stage('encode'):
+                    for per_layer in self._encode_batch(texts, layers, seqs):
+                        for layer, feats in per_layer.items():
+                            for name, vec in feats.items():
+                                buffers[layer].setdefault(name, []).append(vec)
+                count('chunks')
+                count('transcripts', len(texts))
+                writes.append(writer.submit(write, k, buffers))
+                with stage('wait_write'):
+                    while len(writes) > self.pending_writes:
+                        writes.popleft().result()  # re-raises writer errors here
+            with stage('wait_write'):
+                while writes:
+                    writes.popleft().result()
+        finally:
+            tokenizer_pool.shutdown(cancel_futures=True)
+            writer.shutdown(wait=True, cancel_futures=True)
+
+    def _write_chunk(self, manifest: ShardManifest, k: int, buffers: dict, ids: list,
+                     meta: pd.DataFrame):
+        with stage('flush'):
+            entry = self._flush(buffers, ids, meta)
+        with stage('manifest'):
+            manifest.mark_done(k, ids, entry)
+
+    def _encode_batch(self, txts: list, layers: list, seqs: list = None) -> list:
+        kwargs = dict(batch_size=self.batch_size, max_tokens=self.max_tokens,
+                      window=self.window, overlap=self.window_overlap, seqs=seqs)
+        if hasattr(self.ext, 'encode_layers'):
+            return self.ext.encode_batch(txts, layers, **kwargs)
+        return [{None: f} for f in self.ext.encode_batch(txts, **kwargs)]
+
+    def _write_index(self, chunk_ids: List[list], meta: pd.DataFrame):
+        """Metadata of every transcript in output order, tagged with its flush chunk."""
+        ids = [tid for ids in chunk_ids for tid in ids]
+        index = meta.loc[ids].copy()
+        index['chunk'] = [k for k, ids in enumerate(chunk_ids) for _ in ids]
+        _atomic_write(os.path.join(self.output_dir, 'index.csv'),
+                      lambda f: f.write(index.to_csv().encode('utf-8')))
+
+    def _flush(self, buffers: dict, ids: list, meta: pd.DataFrame) -> dict:
+        """Write one chunk; returns the manifest entry describing what was written."""
+        if self.store is not None:
+            feats = {
+                f"{name}{self._layer_suffix(layer)}": np.stack(vecs)
+                for layer, per_layer in buffers.items()
+                for name, vecs in per_layer.items()
+            }
+            start = self.store.num_rows
+            self.store.append(feats, meta.loc[ids])
+            return {'rows': [start, self.store.num_rows]}
+        files = {}
+        for layer, per_layer in buffers.items():
+            files.update(self._write_shards(per_layer, ids, meta, layer))
+        return {'files': files}
+
+    @staticmethod
+    def _layer_suffix(layer: int = None) -> str:
+        return f"_layer{layer}" if layer is not None else ''
+
+    def _write_shards(self, buffers: dict, ids: list, meta: pd.DataFrame, layer: int = None) -> dict:
+        layer_suffix = self._layer_suffix(layer)
+        written = []
         for name, vecs in buffers.items():
             arr = np.stack(vecs)
             fname = f"{name}{layer_suffix}_{ids[0]}_{ids[-1]}.npz"
-            np.savez_compressed(os.path.join(self.output_dir, fname), arr=arr)
+            if self.fmt == 'csr':
+                # SAE latents are mostly zero: size and write time follow nnz
+                mat = sp.csr_matrix(arr)
+                _atomic_write(os.path.join(self.output_dir, fname),
+                              lambda f: sp.save_npz(f, mat, compressed=False))
+            else:
+                _atomic_write(os.path.join(self.output_dir, fname),
+                              lambda f: np.savez_compressed(f, arr=arr))
+            written.append(fname)
         subset = meta.loc[ids]
-        subset.to_csv(os.path.join(self.output_dir, f"meta{layer_suffix}_{ids[0]}_{ids[-1]}.csv"))
+        fname = f"meta{layer_suffix}_{ids[0]}_{ids[-1]}.csv"
+        _atomic_write(os.path.join(self.output_dir, fname),
+                      lambda f: f.write(subset.to_csv().encode('utf-8')))
+        written.append(fname)
+        return {f: os.path.getsize(os.path.join(self.output_dir, f)) for f in written}
 
 class SaeExperiment(BaseExperiment):
     pass
 
 class ClsExperiment(BaseExperiment):
-    pass
\ No newline at end of file
+    pass
+
+def partition(items: list, workers: int) -> List[list]:
+    """Split a list into `workers` contiguous, near-equal slices (some may be empty)."""
+    bounds = np.linspace(0, len(items), workers + 1).round().astype(int)
+    return [items[bounds[w]:bounds[w + 1]] for w in range(workers)]
+
+def _run_worker(exp_cls: type, make_extractor: Callable, dataset: Any, output_dir: str,
+                exp_kwargs: dict, only: List[int], part: int, device: str, threads: int,
+                report_dir: str, report_name: str):
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    exp = exp_cls(make_extractor(device=device), dataset, output_dir, report_dir=report_dir, **exp_kwargs)
+    exp.run(only=only, part=part, report_name=report_name)
+
+def run_parallel(exp_cls: type, make_extractor: Callable, ext_info: dict, dataset: Any,
+                 output_dir: str, workers: int, devices: List[str], **exp_kwargs):
+    """
+    Data-parallel extraction: the flush chunks still to do are split into
+    `workers` contiguous ranges, each run by its own process with its own
+    model replica on devices[w % len(devices)] (CPU workers share the cores
+    evenly). `make_extractor(device=...)` must be picklable, e.g. a
+    functools.partial over SAEExtractor, and `ext_info` carries the
+    extractor's identity (hf_model, sae_checkpoint, layers) so the parent can
+    check the manifest without loading a model. Shard formats are written straight
+    into output_dir under per-worker manifests; memmap workers fill
+    output_dir/parts/<w> stores that are appended to the main store in
+    order. Either way the run ends with one manifest and one index.csv.
+    With profiling on, worker w writes output_dir/run_report.part<w>.
+    """
+    fmt = exp_kwargs.get('fmt', 'dense')
+    # a parent-side experiment (no model) owns the shared manifest and store
+    parent = exp_cls(SimpleNamespace(**ext_info), dataset, output_dir, **exp_kwargs)
+    if parent.is_complete():
+        # checked read-only, so a finished run is never touched
+        print(f"{output_dir} is already complete")
+        return
+    meta = dataset.load_metadata()
+    chunk_ids = parent._chunks()
+    manifest = ShardManifest(output_dir, parent._config(parent._layers()), overwrite=parent.overwrite)
+
+    if fmt == 'memmap':
+        if manifest.fresh:
+            parent.store.reset()
+        done = manifest.store_prefix(list(enumerate(chunk_ids)), parent.store.num_rows)
+        parent.store.truncate(sum(len(ids) for ids in chunk_ids[:done]))
+        todo = list(range(done, len(chunk_ids)))
+    else:
+        todo = [k for k in range(len(chunk_ids)) if not manifest.is_done(k, chunk_ids[k])]
+
+    ctx = mp.get_context('spawn')
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    procs = []
+    for w, only in enumerate(partition(todo, workers)):
+        if not only:
+            continue
+        device = devices[w % len(devices)]
+        if fmt == 'memmap':
+            worker_dir, part = os.path.join(output_dir, 'parts', f"{only[0]}_{only[-1]}"), None
+        else:
+            worker_dir, part = output_dir, w
+        p = ctx.Process(target=_run_worker, args=(
+            exp_cls, make_extractor, dataset, worker_dir, exp_kwargs, only, part, device,
+            threads if device == 'cpu' else None, output_dir, f"run_report.part{w}"))
+        p.start()
+        procs.append((p, only, worker_dir))
+    failed = []
+    for p, only, _ in procs:
+        p.join()
+        if p.exitcode != 0:
+            failed.append((only[0], only[-1]))
+    if failed:
+        raise RuntimeError(f"Extraction workers failed for chunk ranges {failed}; re-run to resume")
+
+    if fmt == 'memmap':
+        # append the worker stores in chunk order, then drop them
+        for _, only, worker_dir in procs:
+            part_store = FeatureStore(worker_dir)
+            part_meta = part_store.load_meta()
+            offset = 0
+            for k in only:
+                n = len(chunk_ids[k])
+                rows = np.arange(offset, offset + n)
+                feats = {view: part_store.select(view, rows=rows) for view in part_store.views()}
+                start = parent.store.num_rows
+                parent.store.append(feats, part_meta.iloc[offset:offset + n])
+                manifest.mark_done(k, chunk_ids[k], {'rows': [start, parent.store.num_rows]})
+                offset += n
+            shutil.rmtree(worker_dir)
+        shutil.rmtree(os.path.join(output_dir, 'parts'), ignore_errors=True)
+    else:
+        manifest = ShardManifest(output_dir, manifest.config)
+        manifest.consolidate()
+    parent._write_index(chunk_ids, meta)
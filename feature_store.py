@@ -0,0 +1,163 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterator, List, Tuple
+
+HEADER = 'store.json'
+META = 'meta.csv'
+
+class FeatureStore:
+    """
+    Appendable, memory-mapped feature store. Each view (one per stat and
+    layer, e.g. 'mean_layer20') is a raw row-major float32 file, and meta.csv
+    holds the transcript metadata row-aligned with every view. store.json
+    records the committed row count (and the committed size of meta.csv), so
+    rows written after the last commit (e.g. by a crashed run) are ignored by
+    readers and overwritten by the next append.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.header = self._read_header()
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.exists(os.path.join(root, HEADER))
+
+    def _read_header(self) -> dict:
+        path = os.path.join(self.root, HEADER)
+        if not os.path.exists(path):
+            return {'rows': 0, 'views': {}, 'meta_bytes': 0}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _write_header(self):
+        path = os.path.join(self.root, HEADER)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f, indent=2)
+        os.replace(tmp, path)
+
+    def _view_path(self, view: str) -> str:
+        return os.path.join(self.root, f"{view}.f32")
+
+    @property
+    def num_rows(self) -> int:
+        return self.header['rows']
+
+    def views(self) -> List[str]:
+        return sorted(self.header['views'])
+
+    def dim(self, view: str) -> int:
+        return self.header['views'][view]['dim']
+
+    def reset(self):
+        """Drop every view and the metadata index."""
+        for view in self.header['views']:
+            if os.path.exists(self._view_path(view)):
+                os.remove(self._view_path(view))
+        if os.path.exists(os.path.join(self.root, META)):
+            os.remove(os.path.join(self.root, META))
+        self.header = {'rows': 0, 'views': {}, 'meta_bytes': 0}
+        self._write_header()
+
+    def truncate(self, rows: int = None):
+        """
+        Cut every view and the metadata back to `rows` (default: the committed
+        row count), discarding anything appended after it, so the next append
+        lines up again after an interrupted write.
+        """
+        rows = self.num_rows if rows is None else rows
+        if rows > self.num_rows:
+            raise ValueError(f"Cannot truncate {self.root} to {rows} rows, only {self.num_rows} committed")
+        for view, spec in self.header['views'].items():
+            path = self._view_path(view)
+            if os.path.exists(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(rows * spec['dim'] * np.dtype(np.float32).itemsize)
+        meta_path = os.path.join(self.root, META)
+        if os.path.exists(meta_path):
+            meta = pd.read_csv(meta_path, index_col='transcript_id').iloc[:rows]
+            meta.to_csv(meta_path + '.tmp')
+            os.replace(meta_path + '.tmp', meta_path)
+        self.header['rows'] = rows
+        self.header['meta_bytes'] = os.path.getsize(meta_path) if os.path.exists(meta_path) else 0
+        self._write_header()
+
+    @staticmethod
+    def _write_at(path: str, offset: int, data: bytes):
+        """Write data at offset and cut the file there, dropping any uncommitted tail."""
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+
+    def append(self, feats: Dict[str, np.ndarray], meta: pd.DataFrame):
+        """
+        Append one block of rows to every view plus the matching metadata rows,
+        then commit the new row count. Rows go right after the committed ones,
+        whatever an interrupted append left behind.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        meta_path = os.path.join(self.root, META)
+        if 'meta_bytes' not in self.header:
+            # store written before meta.csv sizes were recorded
+            self.truncate()
+        n = len(meta)
+        for view, arr in feats.items():
+            arr = np.ascontiguousarray(arr, dtype=np.float32)
+            if arr.shape[0] != n:
+                raise ValueError(f"View '{view}' has {arr.shape[0]} rows, metadata has {n}")
+            spec = self.header['views'].setdefault(view, {'dim': arr.shape[1], 'dtype': 'float32'})
+            if spec['dim'] != arr.shape[1]:
+                raise ValueError(f"View '{view}' has dim {spec['dim']}, got {arr.shape[1]}")
+            offset = self.num_rows * spec['dim'] * np.dtype(np.float32).itemsize
+            self._write_at(self._view_path(view), offset, arr.tobytes())
+        offset = self.header['meta_bytes']
+        text = meta.to_csv(header=offset == 0).encode('utf-8')
+        self._write_at(meta_path, offset, text)
+        self.header['meta_bytes'] = offset + len(text)
+        self.header['rows'] += n
+        self._write_header()
+
+    def open(self, view: str) -> np.ndarray:
+        """Read-only (rows, dim) memory map over the committed rows of a view."""
+        if view not in self.header['views']:
+            raise KeyError(f"No view '{view}' in {self.root}; available: {self.views()}")
+        shape = (self.num_rows, self.dim(view))
+        if self.num_rows == 0:
+            return np.empty(shape, dtype=np.float32)
+        return np.memmap(self._view_path(view), dtype=np.float32, mode='r', shape=shape)
+
+    def iter_chunks(self, view: str, chunk_rows: int = 1024, rows: np.ndarray = None,
+                    cols: np.ndarray = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Yield (offset, block) pairs over the view, optionally restricted to a
+        subset of rows and/or columns. Only one block is in memory at a time.
+        """
+        mm = self.open(view)
+        n = self.num_rows if rows is None else len(rows)
+        for start in range(0, n, chunk_rows):
+            if rows is None:
+                block = mm[start:start + chunk_rows]
+            else:
+                block = mm[np.asarray(rows[start:start + chunk_rows])]
+            yield start, (block if cols is None else block[:, cols])
+
+    def select(self, view: str, rows: np.ndarray = None, cols: np.ndarray = None,
+               chunk_rows: int = 1024) -> np.ndarray:
+        """In-memory copy of the requested rows/columns of a view."""
+        n = self.num_rows if rows is None else len(rows)
+        d = self.dim(view) if cols is None else len(cols)
+        out = np.empty((n, d), dtype=np.float32)
+        for start, block in self.iter_chunks(view, chunk_rows, rows, cols):
+            out[start:start + len(block)] = block
+        return out
+
+    def load_meta(self) -> pd.DataFrame:
+        """Metadata for the committed rows, indexed by transcript_id."""
+        meta_path = os.path.join(self.root, META)
+        if not os.path.exists(meta_path):
+            return pd.DataFrame(index=pd.Index([], name='transcript_id'))
+        meta = pd.read_csv(meta_path, index_col='transcript_id')
+        return meta.iloc[:self.num_rows]
@@ -1,8 +1,12 @@
+import copy
+import threading
 import torch
 import numpy as np
-from typing import Dict
+from typing import Any, Dict, List, Tuple
 from transformers import AutoModelForCausalLM, AutoModel, AutoTokenizer
 from configs import SAE_MODELS, CLS_MODELS
+from activation_cache import ActivationCache
+from profiling import stage, count
 
 class ActivationHook:
     """
@@ -15,7 +19,7 @@ class ActivationHook:
         self.handle = None
 
     def _hook(self, module, input, output):
-        self.activations = output.detach().cpu().numpy()
+        self.activations = output.detach()
 
     def __enter__(self):
         layer = self.model.transformer.h[self.layer_idx].mlp
@@ -25,17 +29,289 @@ class ActivationHook:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.handle.remove()
 
-    def get(self) -> np.ndarray:
+    def get(self) -> torch.Tensor:
         return self.activations
 
+class _StopForward(Exception):
+    """Raised from a forward hook to end the forward pass early."""
+
+class MultiLayerActivationHook:
+    """
+    Context manager to grab activations from several layers in a single forward
+    pass. With stop_early=True the forward is aborted right after the deepest
+    requested layer, so the remaining layers and the LM head are never run.
+    """
+    def __init__(self, model: torch.nn.Module, layer_idxs: List[int], stop_early: bool = True):
+        self.model = model
+        self.layer_idxs = sorted(set(layer_idxs))
+        self.stop_early = stop_early
+        self.activations = {}
+        self.handles = []
+
+    def _make_hook(self, layer_idx: int):
+        def _hook(module, input, output):
+            # kept on the model's device; callers decide what crosses to host
+            self.activations[layer_idx] = output.detach()
+            if self.stop_early and layer_idx == self.layer_idxs[-1]:
+                raise _StopForward()
+        return _hook
+
+    def __enter__(self):
+        for idx in self.layer_idxs:
+            layer = self.model.transformer.h[idx].mlp
+            self.handles.append(layer.register_forward_hook(self._make_hook(idx)))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        # swallow the early-stop signal; anything else propagates
+        return exc_type is _StopForward
+
+    def get(self) -> Dict[int, torch.Tensor]:
+        return self.activations
+
+def length_buckets(lengths: List[int], batch_size: int, max_tokens: int = None) -> List[List[int]]:
+    """
+    Group sequence indices into batches of similar length. Batches hold at most
+    batch_size sequences and, if max_tokens is set, at most max_tokens padded
+    tokens (a sequence longer than max_tokens gets a batch of its own).
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets, cur = [], []
+    for i in order:
+        # lengths are ascending, so the newcomer sets the padded width
+        if cur and (len(cur) >= batch_size or
+                    (max_tokens is not None and (len(cur) + 1) * lengths[i] > max_tokens)):
+            buckets.append(cur)
+            cur = []
+        cur.append(i)
+    if cur:
+        buckets.append(cur)
+    return buckets
+
+def pad_batch(seqs: List[List[int]], pad_id: int, device: str = 'cpu'):
+    """
+    Right-pad token id lists into (input_ids, attention_mask) tensors.
+    """
+    width = max(len(s) for s in seqs)
+    input_ids = torch.full((len(seqs), width), pad_id, dtype=torch.long)
+    mask = torch.zeros((len(seqs), width), dtype=torch.long)
+    for i, s in enumerate(seqs):
+        input_ids[i, :len(s)] = torch.tensor(s, dtype=torch.long)
+        mask[i, :len(s)] = 1
+    return input_ids.to(device), mask.to(device)
+
+def split_windows(seq: List[int], window: int = None, overlap: int = 0,
+                  bos_id: int = None) -> List[Tuple[List[int], int]]:
+    """
+    Cut a token id list into overlapping windows of at most `window` tokens.
+    Returns (window_ids, skip) pairs, where the first `skip` positions of a
+    window are context only (re-prepended BOS, or tokens already counted by
+    the previous window) and must be left out of the pooling. With window=None
+    the sequence is returned whole.
+    """
+    if window is None:
+        return [(seq, 0)]
+    prefix = [bos_id] if bos_id is not None and seq and seq[0] == bos_id else []
+    body = seq[len(prefix):]
+    span = window - len(prefix)
+    if not 0 <= overlap < span:
+        raise ValueError(f"overlap must be in [0, {span}), got {overlap}")
+    out = [(prefix + body[:span], 0)]
+    start = 0
+    while start + span < len(body):
+        start += span - overlap
+        out.append((prefix + body[start:start + span], len(prefix) + overlap))
+    return out
+
+def _segments(lengths: List[int]):
+    """Start and end offsets of consecutive segments with the given lengths."""
+    ends = np.cumsum(lengths)
+    return ends - np.asarray(lengths), ends
+
+class StreamingStats:
+    """
+    Running pooling state (count, sum, max, first and last row) over token
+    activations that arrive one window at a time, so a transcript never has to
+    be held as a full (seq_len, dim) array. `order` is the window position in
+    the transcript; windows may arrive out of order. State stays on the device
+    of the incoming tensors.
+    """
+    def __init__(self):
+        self.count = 0
+        self.sum = None
+        self.max = None
+        self.first = None
+        self.last = None
+        self._first_order = None
+        self._last_order = None
+
+    def update(self, acts: torch.Tensor, order: int = 0):
+        if len(acts) == 0:
+            return
+        if self.count == 0:
+            self.sum = acts.sum(dim=0)
+            self.max = acts.amax(dim=0)
+        else:
+            self.sum += acts.sum(dim=0)
+            torch.maximum(self.max, acts.amax(dim=0), out=self.max)
+        self.count += len(acts)
+        # clones, so the accumulator does not pin the whole batch in memory
+        if self._first_order is None or order < self._first_order:
+            self.first, self._first_order = acts[0].clone(), order
+        if self._last_order is None or order > self._last_order:
+            self.last, self._last_order = acts[-1].clone(), order
+
+    @property
+    def mean(self) -> torch.Tensor:
+        return self.sum / self.count
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """Host copy of the finished state, e.g. for ActivationCache."""
+        state = {name: _to_host(getattr(self, name)) for name in ('sum', 'max', 'first', 'last')}
+        state['count'] = self.count
+        return state
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray]) -> 'StreamingStats':
+        acc = cls()
+        for name in ('sum', 'max', 'first', 'last'):
+            setattr(acc, name, torch.from_numpy(state[name]))
+        acc.count = state['count']
+        acc._first_order, acc._last_order = 0, 0
+        return acc
+
+def _plan_segments(seqs: List[List[int]], window: int, overlap: int, bos_id: int):
+    """(text_idx, order, window_ids, skip) for every window of every sequence."""
+    return [
+        (i, order, ids, skip)
+        for i, seq in enumerate(seqs)
+        for order, (ids, skip) in enumerate(split_windows(seq, window, overlap, bos_id))
+    ]
+
+def _counted_mask(mask: torch.Tensor, skips: List[int]) -> torch.Tensor:
+    """Attention mask with each row's leading context-only positions cleared."""
+    counted = mask.bool()
+    for row, skip in enumerate(skips):
+        counted[row, :skip] = False
+    return counted
+
+def _to_host(t: torch.Tensor) -> np.ndarray:
+    return t.detach().cpu().numpy()
+
+_thread_state = threading.local()
+
+def _thread_tokenizer(tokenizer):
+    """
+    The tokenizer itself on the main thread, a per-thread copy elsewhere: the
+    fast-tokenizer backend rejects concurrent calls that change truncation.
+    """
+    if threading.current_thread() is threading.main_thread():
+        return tokenizer
+    copies = getattr(_thread_state, 'tokenizers', None)
+    if copies is None:
+        copies = _thread_state.tokenizers = {}
+    if id(tokenizer) not in copies:
+        copies[id(tokenizer)] = copy.deepcopy(tokenizer)
+    return copies[id(tokenizer)]
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Identifies a tokenizer well enough to tell whether token ids are reusable."""
+    return f"{tokenizer.name_or_path}:{type(tokenizer).__name__}:{len(tokenizer)}:{tokenizer.model_max_length}"
+
+def _encode_pooled(ext, texts: List[str], layer_keys: list, batch_size: int, max_tokens: int,
+                   window: int, overlap: int, seqs: List[List[int]] = None) -> List[Dict[Any, StreamingStats]]:
+    """
+    Batching, windowing and caching loop shared by the extractors'
+    encode_batch. `ext` supplies tokenize(), _forward() (padded batch ->
+    per-layer activations), _transform() (applied to the unmasked positions)
+    and an optional ActivationCache. `seqs` are the texts' token ids if they
+    were tokenized ahead of time. Returns one {layer key: StreamingStats}
+    dict per text; entries found in the cache skip the model entirely.
+    """
+    accs = [{} for _ in texts]
+    keys = None
+    if ext.cache is not None:
+        with stage('cache_get'):
+            keys = [{lk: ext._cache_key(text, lk, window, overlap) for lk in layer_keys} for text in texts]
+            for i, per_text in enumerate(keys):
+                for lk, key in per_text.items():
+                    state = ext.cache.get(key)
+                    if state is not None:
+                        accs[i][lk] = StreamingStats.from_state(state)
+    missing = {i: [lk for lk in layer_keys if lk not in accs[i]] for i in range(len(texts))}
+    todo = [i for i in range(len(texts)) if missing[i]]
+    count('texts', len(texts))
+    count('cache_hits', len(texts) - len(todo))
+    if not todo:
+        return accs
+    for i in todo:
+        for lk in missing[i]:
+            accs[i][lk] = StreamingStats()
+    run_keys = [lk for lk in layer_keys if any(lk in missing[i] for i in todo)]
+
+    if seqs is None:
+        with stage('tokenize'):
+            seqs = ext.tokenize([texts[i] for i in todo], truncation=window is None)
+    else:
+        seqs = [seqs[i] for i in todo]
+    segs = _plan_segments(seqs, window, overlap, ext.tokenizer.bos_token_id)
+    pad_id = ext.tokenizer.pad_token_id or 0
+    for bucket in length_buckets([len(seg[2]) for seg in segs], batch_size, max_tokens):
+        batch = [segs[j] for j in bucket]
+        input_ids, mask = pad_batch([seg[2] for seg in batch], pad_id, ext.device)
+        counted = _counted_mask(mask, [seg[3] for seg in batch])
+        starts, ends = _segments(counted.sum(dim=1).tolist())
+        count('batches')
+        count('tokens', int(ends[-1]))
+        count('padded_tokens', mask.numel())
+        with torch.no_grad():
+            with stage('forward'):
+                layer_acts = ext._forward(input_ids, mask, run_keys)
+            for lk, acts in layer_acts.items():
+                suffix = '' if lk is None else f'.layer{lk}'
+                with stage('transform' + suffix):
+                    out = ext._transform(acts[counted])  # (counted_tokens, dim), windows back to back
+                with stage('stats' + suffix):
+                    for (j, order, _, _), s, e in zip(batch, starts, ends):
+                        if lk in missing[todo[j]]:
+                            accs[todo[j]][lk].update(out[s:e], order)
+    if keys is not None:
+        with stage('cache_put'):
+            for i in todo:
+                for lk in missing[i]:
+                    ext.cache.put(keys[i][lk], accs[i][lk].state())
+    return accs
+
+class PrunedSAE(torch.nn.Module):
+    """
+    JumpReLU SAE encoder restricted to a subset of latents: W_enc, b_enc and
+    threshold are sliced to `features` (in that order), so only those latents
+    are ever computed.
+    """
+    def __init__(self, sae: torch.nn.Module, features: List[int]):
+        super().__init__()
+        idx = torch.as_tensor(list(features), dtype=torch.long, device=sae.W_enc.device)
+        self.register_buffer('W_enc', sae.W_enc.detach()[:, idx].contiguous())
+        self.register_buffer('b_enc', sae.b_enc.detach()[idx].contiguous())
+        self.register_buffer('threshold', sae.threshold.detach()[idx].contiguous())
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        pre = x @ self.W_enc + self.b_enc
+        return torch.relu(pre) * (pre > self.threshold)
+
 class SAEExtractor:
-    def __init__(self, sae_id: str, device: str = 'cpu'):
+    def __init__(self, sae_id: str, device: str = 'cpu', cache: ActivationCache = None):
         cfg = SAE_MODELS[sae_id]
         self.hf_model = cfg['hf_model']
         self.sae_checkpoint = cfg['sae_checkpoint']
         self.latent_dim = cfg['latent_dim']
         self.layers = cfg['layers']
         self.device = device
+        self.cache = cache
+        self.features = None  # latent indices kept by prune(), None for all
 
         from torch import load
         self.tokenizer = AutoTokenizer.from_pretrained(self.hf_model)
@@ -43,13 +319,100 @@ class SAEExtractor:
         self.sae = load(self.sae_checkpoint, map_location=device)
         self.sae.eval()
 
+    @classmethod
+    def from_components(cls, tokenizer, model: torch.nn.Module, sae: torch.nn.Module, layers: List[int],
+                        hf_model: str, sae_checkpoint: str, device: str = 'cpu',
+                        cache: ActivationCache = None) -> 'SAEExtractor':
+        """
+        An extractor around modules built in memory rather than SAE_MODELS
+        checkpoints, e.g. the small random ones of runners.benchmark. `model`
+        must expose its blocks as model.transformer.h; hf_model and
+        sae_checkpoint only name the run in manifests and cache keys.
+        """
+        self = cls.__new__(cls)
+        self.hf_model = hf_model
+        self.sae_checkpoint = sae_checkpoint
+        self.latent_dim = sae.W_enc.shape[1]
+        self.layers = list(layers)
+        self.device = device
+        self.cache = cache
+        self.features = None
+        self.tokenizer = tokenizer
+        self.model = model.to(device).eval()
+        self.sae = sae.to(device).eval()
+        return self
+
+    def prune(self, features: List[int], layer_idx: int) -> 'SAEExtractor':
+        """
+        Keep only what scoring `features` at `layer_idx` needs: the SAE
+        encoder is sliced to those latents (pooled outputs then have
+        len(features) columns, in the given order) and the transformer blocks
+        above layer_idx are dropped from the model. Returns self.
+        """
+        self.sae = PrunedSAE(self.sae, features).eval()
+        self.model.transformer.h = self.model.transformer.h[:layer_idx + 1]
+        self.layers = [layer_idx]
+        self.latent_dim = len(features)
+        self.features = [int(f) for f in features]
+        return self
+
     def encode(self, text: str, layer_idx: int) -> np.ndarray:
+        return self.encode_layers(text, [layer_idx])[layer_idx]  # (seq_len, latent_dim)
+
+    def encode_layers(self, text: str, layer_idxs: List[int] = None) -> Dict[int, np.ndarray]:
+        """
+        Run one forward pass and return SAE latents for every requested layer
+        (defaults to all configured layers), keyed by layer index.
+        """
+        layer_idxs = self.layers if layer_idxs is None else layer_idxs
         inputs = self.tokenizer(text, return_tensors='pt', truncation=True).to(self.device)
-        with ActivationHook(self.model, layer_idx=layer_idx) as hook:
-            _ = self.model(**inputs)
-            acts = hook.get()[0]  # (seq_len, hidden)
-        sae_out = self.sae(torch.from_numpy(acts).to(self.device)).detach().cpu().numpy()
-        return sae_out  # (seq_len, latent_dim)
+        with torch.no_grad():
+            with MultiLayerActivationHook(self.model, layer_idxs) as hook:
+                _ = self.model(**inputs)
+            out = {}
+            for layer_idx, acts in hook.get().items():
+                out[layer_idx] = _to_host(self.sae(acts[0]))  # acts[0]: (seq_len, hidden)
+        return out
+
+    def tokenize(self, texts: List[str], truncation: bool = True) -> List[List[int]]:
+        return _thread_tokenizer(self.tokenizer)(list(texts), truncation=truncation)['input_ids']
+
+    def encode_batch(self, texts: List[str], layer_idxs: List[int] = None,
+                     batch_size: int = 8, max_tokens: int = None, window: int = None,
+                     overlap: int = 0, seqs: List[List[int]] = None) -> List[Dict[int, Dict[str, np.ndarray]]]:
+        """
+        Pooled SAE features for many texts. Texts are bucketed by token length
+        and right-padded within a bucket; only positions under the attention
+        mask reach the SAE and the pooling. If `window` is set, texts are not
+        truncated but walked in overlapping windows (see split_windows) whose
+        latents are folded into StreamingStats as they are produced. With an
+        ActivationCache, (text, layer) pairs already seen are not recomputed and
+        only the missing layers are hooked. Returns, per input text and in
+        input order, a dict of layer index -> stats dict. Pass `seqs` (from
+        tokenize(texts, truncation=window is None)) to skip tokenization.
+        """
+        layer_idxs = self.layers if layer_idxs is None else layer_idxs
+        accs = _encode_pooled(self, texts, layer_idxs, batch_size, max_tokens, window, overlap, seqs)
+        return [{layer_idx: self.pool(acc) for layer_idx, acc in per_text.items()} for per_text in accs]
+
+    def _forward(self, input_ids: torch.Tensor, mask: torch.Tensor,
+                 layer_idxs: List[int]) -> Dict[int, torch.Tensor]:
+        with MultiLayerActivationHook(self.model, layer_idxs) as hook:
+            _ = self.model(input_ids=input_ids, attention_mask=mask)
+        return hook.get()
+
+    def _transform(self, acts: torch.Tensor) -> torch.Tensor:
+        return self.sae(acts)
+
+    def _cache_key(self, text: str, layer_idx: int, window: int, overlap: int) -> str:
+        sae = self.sae_checkpoint
+        if self.features is not None:
+            sae += '[' + ActivationCache.text_hash(','.join(map(str, self.features))) + ']'
+        return ActivationCache.make_key(
+            model=self.hf_model, sae=sae, layer=layer_idx,
+            tokenizer=tokenizer_fingerprint(self.tokenizer), text=ActivationCache.text_hash(text),
+            window=window, overlap=overlap if window is not None else None,
+        )
 
     def stats(self, acts: np.ndarray) -> Dict[str, np.ndarray]:
         return {
@@ -59,22 +422,80 @@ class SAEExtractor:
             'last': acts[-1],
         }
 
+    def pool(self, acc: StreamingStats) -> Dict[str, np.ndarray]:
+        """Same pooling as stats(), read off a StreamingStats accumulator."""
+        return {
+            'sum': _to_host(acc.sum),
+            'mean': _to_host(acc.mean),
+            'max': _to_host(acc.max),
+            'last': _to_host(acc.last),
+        }
+
 class ClsExtractor:
-    def __init__(self, cls_id: str, device: str = 'cpu'):
+    def __init__(self, cls_id: str, device: str = 'cpu', cache: ActivationCache = None):
         self.hf_model = CLS_MODELS[cls_id]
         self.device = device
+        self.cache = cache
         self.tokenizer = AutoTokenizer.from_pretrained(self.hf_model)
         self.model = AutoModel.from_pretrained(self.hf_model).to(device)
         self.d = self.model.config.hidden_size
 
+    @classmethod
+    def from_components(cls, tokenizer, model: torch.nn.Module, hf_model: str, device: str = 'cpu',
+                        cache: ActivationCache = None) -> 'ClsExtractor':
+        """An extractor around a base model built in memory; see SAEExtractor.from_components."""
+        self = cls.__new__(cls)
+        self.hf_model = hf_model
+        self.device = device
+        self.cache = cache
+        self.tokenizer = tokenizer
+        self.model = model.to(device).eval()
+        self.d = self.model.config.hidden_size
+        return self
+
     def encode(self, text: str) -> np.ndarray:
         inputs = self.tokenizer(text, return_tensors='pt', truncation=True).to(self.device)
         out = self.model(**inputs)
         h = out.last_hidden_state.detach().cpu().numpy()[0]
         return h  # (seq_len, hidden)
 
+    def tokenize(self, texts: List[str], truncation: bool = True) -> List[List[int]]:
+        return _thread_tokenizer(self.tokenizer)(list(texts), truncation=truncation)['input_ids']
+
+    def encode_batch(self, texts: List[str], batch_size: int = 8, max_tokens: int = None,
+                     window: int = None, overlap: int = 0,
+                     seqs: List[List[int]] = None) -> List[Dict[str, np.ndarray]]:
+        """
+        Pooled last-hidden-state features for many texts, bucketed by token
+        length and masked so padding does not enter the pooling. `window` and
+        `overlap` enable sliding-window encoding, and an ActivationCache is
+        consulted, as in SAEExtractor.encode_batch; so are pre-tokenized `seqs`.
+        """
+        accs = _encode_pooled(self, texts, [None], batch_size, max_tokens, window, overlap, seqs)
+        return [self.pool(per_text[None]) for per_text in accs]
+
+    def _forward(self, input_ids: torch.Tensor, mask: torch.Tensor, layer_keys: list) -> dict:
+        return {None: self.model(input_ids=input_ids, attention_mask=mask).last_hidden_state}
+
+    def _transform(self, h: torch.Tensor) -> torch.Tensor:
+        return h
+
+    def _cache_key(self, text: str, layer_key: None, window: int, overlap: int) -> str:
+        return ActivationCache.make_key(
+            model=self.hf_model, layer='last_hidden_state',
+            tokenizer=tokenizer_fingerprint(self.tokenizer), text=ActivationCache.text_hash(text),
+            window=window, overlap=overlap if window is not None else None,
+        )
+
     def stats(self, h: np.ndarray) -> Dict[str, np.ndarray]:
         return {
             'cls': h[0],
             'mean': np.mean(h, axis=0),
-        }
\ No newline at end of file
+        }
+
+    def pool(self, acc: StreamingStats) -> Dict[str, np.ndarray]:
+        """Same pooling as stats(), read off a StreamingStats accumulator."""
+        return {
+            'cls': _to_host(acc.first),
+            'mean': _to_host(acc.mean),
+        }
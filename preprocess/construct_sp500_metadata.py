@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import pandas as pd
 
 def load_sp500_components(input_csv: str) -> pd.DataFrame:
@@ -13,17 +14,24 @@ def expand_dates(df: pd.DataFrame, start: str, end: str) -> pd.DataFrame:
     """
     For each ticker, expand its membership over each quarter (or other freq)
     between start and end, so you get one row per (ticker, period).
+    Membership [date_added, date_removed] is an interval, so its periods are
+    one contiguous slice of the sorted grid, found by binary search.
     """
     periods = pd.date_range(start, end, freq='Q')
-    records = []
-    for _, row in df.iterrows():
-        for period in periods:
-            if row['date_added'] <= period and (pd.isna(row['date_removed']) or period <= row['date_removed']):
-                records.append({
-                    'ticker': row['ticker'],
-                    'period_end': period
-                })
-    return pd.DataFrame(records)
+    added = pd.to_datetime(df['date_added']).to_numpy()
+    removed = pd.to_datetime(df['date_removed']).to_numpy()
+    lo = np.searchsorted(periods.to_numpy(), added, side='left')
+    hi = np.where(pd.isna(removed), len(periods), np.searchsorted(periods.to_numpy(), removed, side='right'))
+    counts = np.where(pd.isna(added), 0, np.maximum(hi - lo, 0))
+    if counts.sum() == 0:
+        return pd.DataFrame()
+    # period index of every output row: lo of its ticker plus its rank within the ticker
+    firsts = np.repeat(np.cumsum(counts) - counts, counts)
+    idx = np.repeat(lo, counts) + np.arange(counts.sum()) - firsts
+    return pd.DataFrame({
+        'ticker': np.repeat(df['ticker'].to_numpy(), counts),
+        'period_end': periods[idx],
+    })
 
 def save_sp500(df: pd.DataFrame, out_csv: str):
     """Write expanded S&P 500 membership to CSV."""
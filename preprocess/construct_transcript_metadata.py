@@ -2,6 +2,7 @@ import os
 import csv
 import json
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict
 
 def load_raw_transcripts(input_dir: str) -> List[Dict]:
@@ -16,26 +17,41 @@ def load_raw_transcripts(input_dir: str) -> List[Dict]:
                 records.append(json.loads(line))
     return records
 
+def _metadata_row(rec: Dict) -> Dict:
+    comps = rec.get('component_texts', [])
+    return {
+        'transcript_id': rec['transcript_id'],
+        'company_id': rec.get('company_id'),
+        'date': rec.get('date'),
+        'num_components': len(comps),
+        'total_tokens': sum(len(text.split()) for text in comps)
+    }
+
 def build_metadata(records: List[Dict]) -> pd.DataFrame:
     """
     From raw transcript records, extract one row per transcript:
     transcript_id, company_id, date, num_components, total_tokens, etc.
     """
-    rows = []
-    for rec in records:
-        tid = rec['transcript_id']
-        cid = rec.get('company_id')
-        date = rec.get('date')
-        comps = rec.get('component_texts', [])
-        num_comps = len(comps)
-        total_tokens = sum(len(text.split()) for text in comps)
-        rows.append({
-            'transcript_id': tid,
-            'company_id': cid,
-            'date': date,
-            'num_components': num_comps,
-            'total_tokens': total_tokens
-        })
+    df = pd.DataFrame([_metadata_row(rec) for rec in records])
+    df = df.sort_values(['company_id','date'])
+    return df
+
+def _file_metadata_rows(path: str) -> List[Dict]:
+    """Metadata rows of one JSONL file, parsed a line at a time."""
+    with open(path, 'r') as f:
+        return [_metadata_row(json.loads(line)) for line in f]
+
+def build_metadata_streaming(input_dir: str, workers: int = None) -> pd.DataFrame:
+    """
+    build_metadata(load_raw_transcripts(input_dir)) without holding the
+    records: each file is streamed by its own worker process and only the
+    small metadata rows come back. Rows are combined in the same file order,
+    so the result (including the sort of ties) is identical.
+    """
+    paths = [os.path.join(input_dir, fname) for fname in os.listdir(input_dir)
+             if fname.endswith('.jsonl')]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = [row for file_rows in pool.map(_file_metadata_rows, paths) for row in file_rows]
     df = pd.DataFrame(rows)
     df = df.sort_values(['company_id','date'])
     return df
@@ -51,8 +67,9 @@ if __name__ == '__main__':
                         help='Directory of transcript JSONL files')
     parser.add_argument('--output-csv', required=True,
                         help='Path to write transcript_metadata.csv')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes reading JSONL files in parallel (default: one per CPU)')
     args = parser.parse_args()
 
-    recs = load_raw_transcripts(args.input_dir)
-    meta = build_metadata(recs)
+    meta = build_metadata_streaming(args.input_dir, workers=args.workers)
     save_metadata(meta, args.output_csv)
\ No newline at end of file
@@ -1,49 +1,126 @@
 """
 Helper functions for loading and cleaning various financial datasets (SAS/CSV).
 """
+import os
+import glob
+import json
+import hashlib
 import pandas as pd
 from datetime import datetime
 dateutil_parser = pd.to_datetime
 
+SAS_CHUNKSIZE = 100_000
+
 
 def decode_bytes_cols(df: pd.DataFrame) -> pd.DataFrame:
     """
     Decode any byte-string columns in the DataFrame to UTF-8 strings.
+    Columns holding only bytes are decoded in one vectorized pass; columns
+    mixing bytes with other values fall back to decoding element by element.
     """
     for col in df.columns:
-        if df[col].dtype == object:
+        if df[col].dtype != object:
+            continue
+        kind = pd.api.types.infer_dtype(df[col], skipna=True)
+        if kind == 'bytes':
+            df[col] = df[col].str.decode('utf-8')
+        elif kind not in ('string', 'empty'):
+            # 'mixed', 'mixed-integer', ...: any of these can hold some bytes
             df[col] = df[col].apply(
                 lambda x: x.decode('utf-8') if isinstance(x, (bytes, bytearray)) else x
             )
     return df
 
 
-def load_sas_dataset(path: str, usecols: list = None) -> pd.DataFrame:
+def read_sas_columns(path: str, usecols: list = None, chunksize: int = SAS_CHUNKSIZE) -> pd.DataFrame:
+    """
+    Parse a .sas7bdat file `chunksize` rows at a time, keeping only `usecols`
+    of each chunk (and decoding its byte columns) before reading the next, so
+    the full-width table is never held in memory.
+    """
+    chunks = []
+    with pd.read_sas(path, format='sas7bdat', encoding='latin1', chunksize=chunksize) as reader:
+        for chunk in reader:
+            if usecols:
+                chunk = chunk[usecols]
+            chunks.append(decode_bytes_cols(chunk))
+    if not chunks:
+        return pd.DataFrame(columns=usecols)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _cache_paths(path: str, usecols: list, cache_dir: str):
+    """(cache file prefix for this column set, full name for the current source stamp)."""
+    st = os.stat(path)
+    cols = hashlib.sha256(json.dumps(usecols).encode('utf-8')).hexdigest()[:12]
+    stamp = hashlib.sha256(f"{st.st_size}:{st.st_mtime_ns}".encode('utf-8')).hexdigest()[:12]
+    prefix = os.path.join(cache_dir, f"{os.path.basename(path)}-{cols}-")
+    return prefix, prefix + stamp
+
+
+def _read_cache(base: str):
+    if os.path.exists(base + '.parquet'):
+        return pd.read_parquet(base + '.parquet')
+    if os.path.exists(base + '.pkl'):
+        return pd.read_pickle(base + '.pkl')
+    return None
+
+
+def _write_cache(df: pd.DataFrame, prefix: str, base: str):
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    # entries for older versions of the same source and columns are dead
+    for old in glob.glob(glob.escape(prefix) + '*'):
+        os.remove(old)
+    try:
+        df.to_parquet(base + '.parquet.tmp', index=False)
+        os.replace(base + '.parquet.tmp', base + '.parquet')
+    except (ImportError, ValueError, TypeError):
+        # no parquet engine, or columns parquet cannot hold
+        if os.path.exists(base + '.parquet.tmp'):
+            os.remove(base + '.parquet.tmp')
+        df.to_pickle(base + '.pkl.tmp')
+        os.replace(base + '.pkl.tmp', base + '.pkl')
+
+
+def load_sas_dataset(path: str, usecols: list = None, cache_dir: str = None,
+                     use_cache: bool = True, chunksize: int = SAS_CHUNKSIZE) -> pd.DataFrame:
     """
     Load a SAS dataset (.sas7bdat) into a pandas DataFrame, with optional column selection.
+    The parsed columns are cached (Parquet, or pickle without a Parquet
+    engine) in cache_dir, by default a .sas_cache directory next to the file,
+    keyed on the column selection and the file's size and mtime; later loads
+    of an unchanged file read the cache instead of parsing the SAS file.
     """
-    df = pd.read_sas(path, format='sas7bdat', encoding='latin1')
-    if usecols:
-        df = df[usecols]
-    df = decode_bytes_cols(df)
+    if not use_cache:
+        return read_sas_columns(path, usecols, chunksize)
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), '.sas_cache')
+    prefix, base = _cache_paths(path, usecols, cache_dir)
+    df = _read_cache(base)
+    if df is not None:
+        return df
+    df = read_sas_columns(path, usecols, chunksize)
+    try:
+        _write_cache(df, prefix, base)
+    except OSError:
+        pass  # read-only data directory: keep going without a cache
     return df
 
 
-def load_gvkey(path: str) -> pd.DataFrame:
+def load_gvkey(path: str, **sas_kwargs) -> pd.DataFrame:
     """
     Load CapitalIQ GVKEY mapping, ensuring COMPANYID as int and GVKEY as str.
     """
-    df = load_sas_dataset(path, usecols=['COMPANYID','GVKEY'])
+    df = load_sas_dataset(path, usecols=['COMPANYID','GVKEY'], **sas_kwargs)
     df['COMPANYID'] = df['COMPANYID'].astype(int)
     df['GVKEY'] = df['GVKEY'].astype(str)
     return df
 
 
-def load_surprise(path: str) -> pd.DataFrame:
+def load_surprise(path: str, **sas_kwargs) -> pd.DataFrame:
     """
     Load SUER score dataset and filter out extreme 1st and 99th percentiles.
     """
-    df = load_sas_dataset(path)
+    df = load_sas_dataset(path, **sas_kwargs)
     # compute quantile bounds
     low = df['SUESCORE'].quantile(0.01)
     high = df['SUESCORE'].quantile(0.99)
@@ -52,20 +129,20 @@ def load_surprise(path: str) -> pd.DataFrame:
     return df
 
 
-def load_compustat_link(path: str) -> pd.DataFrame:
+def load_compustat_link(path: str, **sas_kwargs) -> pd.DataFrame:
     """
     Load Compustat-CRSP link table with key fields.
     """
     cols = ['GVKEY','TIC','LIID','LINKDT','LINKENDDT','LINKPRIM','LINKTYPE','LPERMCO','LPERMNO','CONM','CUSIP']
-    df = load_sas_dataset(path, usecols=cols)
+    df = load_sas_dataset(path, usecols=cols, **sas_kwargs)
     return df
 
 
-def load_ibes(path: str) -> pd.DataFrame:
+def load_ibes(path: str, **sas_kwargs) -> pd.DataFrame:
     """
     Load IBES dataset and decode CUSIP.
     """
-    df = load_sas_dataset(path)
+    df = load_sas_dataset(path, **sas_kwargs)
     if 'CUSIP' in df.columns:
         df['CUSIP'] = df['CUSIP'].astype(str)
     return df
@@ -77,17 +154,22 @@ if __name__ == '__main__':
     parser.add_argument('--surprise', help='Path to surpsumu1.sas7bdat')
     parser.add_argument('--compustat', help='Path to compustat link .sas7bdat')
     parser.add_argument('--ibes', help='Path to ibes .sas7bdat')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Where parsed tables are cached (default: .sas_cache next to each file)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always parse the SAS files, without reading or writing the cache')
     args = parser.parse_args()
 
+    sas_kwargs = dict(cache_dir=args.cache_dir, use_cache=not args.no_cache)
     if args.gvkey:
-        df = load_gvkey(args.gvkey)
+        df = load_gvkey(args.gvkey, **sas_kwargs)
         print(f'Loaded GVKEY: {len(df)} rows')
     if args.surprise:
-        df = load_surprise(args.surprise)
+        df = load_surprise(args.surprise, **sas_kwargs)
         print(f'Filtered surprise to {len(df)} rows')
     if args.compustat:
-        df = load_compustat_link(args.compustat)
+        df = load_compustat_link(args.compustat, **sas_kwargs)
         print(f'Loaded compustat link: {len(df)} rows')
     if args.ibes:
-        df = load_ibes(args.ibes)
+        df = load_ibes(args.ibes, **sas_kwargs)
         print(f'Loaded IBES: {len(df)} rows')
@@ -0,0 +1,246 @@
+import os
+import sys
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+# Opt-in run instrumentation. Code marks its stages with `with stage(name):`
+# and its throughput with count(name, n); both are no-ops until enable() is
+# called, so instrumented hot paths cost nothing in normal runs.
+
+# what a run records: stage timings/counters, or those plus a cProfile dump
+MODES = ('stages', 'cprofile')
+ENV_VAR = 'SAE_FIRE_PROFILE'
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_stages: Dict[str, dict] = {}
+_counters: Dict[str, float] = {}
+_info: Dict[str, object] = {}
+_hooks: List[tuple] = []
+_cprofile = None
+_started = None
+# the thread that called enable(), i.e. the one driving the model
+_device_thread = None
+
+
+def _torch_cuda():
+    # only look at CUDA if the process already uses torch
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+def _host_peak_bytes() -> int:
+    try:
+        import resource
+    except ImportError:  # not on POSIX
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Stage:
+    """
+    Times one stage on the calling thread. On CUDA, stages on the thread that
+    enabled profiling synchronise the device at both ends so asynchronous
+    kernels are charged to the stage that launched them, and track the device
+    memory peak per stage (including the peaks of nested stages). Stages on
+    other threads (tokenizers, writers) only record wall time: syncing or
+    resetting the process-wide peak there would stall them on the GPU queue
+    and cut short the peaks of the model's stages.
+    """
+    __slots__ = ('name', 'start', 'peak', 'cuda')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        cuda = self.cuda = _torch_cuda() if threading.get_ident() == _device_thread else None
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.peak = None
+        if cuda is not None:
+            self.peak = 0
+            cuda.synchronize()
+            # hand the peak so far to the enclosing stages before resetting it
+            peak = cuda.max_memory_allocated()
+            for frame in stack:
+                frame.peak = max(frame.peak, peak)
+            cuda.reset_peak_memory_stats()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        cuda = self.cuda
+        if cuda is not None:
+            cuda.synchronize()
+        seconds = time.perf_counter() - self.start
+        stack = _local.stack
+        stack.pop()
+        if cuda is not None:
+            peak = cuda.max_memory_allocated()
+            self.peak = max(self.peak, peak)
+            for frame in stack:
+                frame.peak = max(frame.peak, peak)
+        with _lock:
+            entry = _stages.setdefault(self.name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                   'device_peak_bytes': None})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            if self.peak is not None:
+                entry['device_peak_bytes'] = max(entry['device_peak_bytes'] or 0, self.peak)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def env_mode():
+    """The profiling mode asked for in $SAE_FIRE_PROFILE, or None."""
+    mode = os.environ.get(ENV_VAR) or None
+    if mode is not None and mode not in MODES:
+        raise ValueError(f"{ENV_VAR}={mode} is not one of {MODES}")
+    return mode
+
+
+def add_profile_arg(parser, report: str):
+    """The --profile option of an entry point; `report` says what gets written where."""
+    parser.add_argument('--profile', default=env_mode(), choices=MODES,
+                        help=f'Write stage timings, throughput and memory peaks to {report}; '
+                             f'cprofile also dumps a .pstats (default: ${ENV_VAR})')
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def stage(name: str):
+    """Context manager charging its block's wall time to `name`."""
+    return _Stage(name) if _enabled else _NULL_STAGE
+
+
+def count(name: str, n: float = 1):
+    """Add n to counter `name` (e.g. tokens, transcripts, cache hits)."""
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def annotate(**fields):
+    """Attach run settings (model, batch size, ...) to the report."""
+    if _enabled:
+        with _lock:
+            _info.update(fields)
+
+
+def add_hook(start: Callable[[], None], stop: Callable[[], None]):
+    """
+    Run start() when profiling is enabled and stop() when the report is
+    written, e.g. to drive a sampling profiler or torch.profiler for the run.
+    """
+    _hooks.append((start, stop))
+
+
+def enable(cprofile: bool = False):
+    """
+    Start recording from a clean slate; with cprofile, also run cProfile on
+    this thread. Device syncs and memory peaks are taken on this thread only.
+    """
+    global _enabled, _cprofile, _started, _device_thread
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _info.clear()
+    _started = time.perf_counter()
+    _device_thread = threading.get_ident()
+    _enabled = True
+    if cprofile:
+        import cProfile
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+    for start, _ in _hooks:
+        start()
+
+
+def report() -> dict:
+    """Snapshot of the run so far: wall time, per-stage timings, counters and rates."""
+    wall = time.perf_counter() - _started if _started is not None else 0.0
+    with _lock:
+        stages = {name: dict(entry) for name, entry in _stages.items()}
+        counters = dict(_counters)
+        info = dict(_info)
+    for entry in stages.values():
+        entry['mean_ms'] = 1000.0 * entry['seconds'] / entry['calls']
+    rates = {f"{name}_per_sec": value / wall for name, value in counters.items() if wall > 0}
+    return {'info': info, 'wall_seconds': wall, 'host_peak_rss_bytes': _host_peak_bytes(),
+            'stages': stages, 'counters': counters, 'rates': rates}
+
+
+def write_report(out_dir: str, name: str = 'run_report') -> str:
+    """
+    Stop recording and write <name>.json (everything) and <name>.csv (one
+    row per stage) to out_dir, plus <name>.pstats when cProfile was on.
+    Returns the JSON path.
+    """
+    global _enabled, _cprofile
+    if _cprofile is not None:
+        _cprofile.disable()
+    for _, stop in _hooks:
+        stop()
+    data = report()
+    _enabled = False
+    os.makedirs(out_dir, exist_ok=True)
+    json_path = os.path.join(out_dir, f"{name}.json")
+    with open(json_path, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+    with open(os.path.join(out_dir, f"{name}.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['stage', 'calls', 'seconds', 'mean_ms', 'max_seconds', 'device_peak_bytes',
+                         'share_of_wall'])
+        for stage_name, entry in sorted(data['stages'].items(), key=lambda kv: -kv[1]['seconds']):
+            writer.writerow([stage_name, entry['calls'], round(entry['seconds'], 6), round(entry['mean_ms'], 3),
+                             round(entry['max_seconds'], 6), entry['device_peak_bytes'],
+                             round(entry['seconds'] / data['wall_seconds'], 4) if data['wall_seconds'] else ''])
+    if _cprofile is not None:
+        _cprofile.dump_stats(os.path.join(out_dir, f"{name}.pstats"))
+        _cprofile = None
+    return json_path
+
+
+@contextmanager
+def profiled(mode: str, out_dir: str, name: str = 'run_report', info: dict = None):
+    """
+    Record the enclosed block into out_dir/<name>.* when `mode` is one of
+    MODES; with mode None it does nothing. `info` is attached to the report.
+    """
+    if not mode:
+        yield
+        return
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode '{mode}', expected one of {MODES}")
+    enable(cprofile=mode == 'cprofile')
+    annotate(**(info or {}))
+    try:
+        yield
+    finally:
+        path = write_report(out_dir, name)
+        print(f"Run report written to {path}")
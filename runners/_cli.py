@@ -0,0 +1,110 @@
+import argparse
+from functools import partial
+from data_io import TranscriptDataset
+from activation_cache import ActivationCache
+from token_store import TokenStore
+from experiments import SHARD_FORMATS, check_window, run_parallel
+import profiling
+
+# Command-line options shared by the extraction entry points (run_sae, run_cls,
+# run_jobs) and the scoring server, so they stay in step.
+
+
+def add_encoding_args(parser: argparse.ArgumentParser, batch_size: int = 1):
+    """How transcripts are batched and windowed for the forward pass."""
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+                        help='Max transcripts per forward pass')
+    parser.add_argument('--max-tokens-per-batch', type=int, default=None,
+                        help='Max padded tokens per forward pass')
+    parser.add_argument('--window', type=int, default=None,
+                        help='Encode full transcripts in windows of this many tokens '
+                             '(default: truncate to the model context)')
+    parser.add_argument('--window-overlap', type=int, default=128,
+                        help='Context tokens shared by consecutive windows')
+
+
+def check_encoding_args(parser: argparse.ArgumentParser, args):
+    """Reject add_encoding_args options that could only fail once encoding starts."""
+    try:
+        check_window(args.window, args.window_overlap)
+    except ValueError as e:
+        parser.error(f"--window {args.window} --window-overlap {args.window_overlap}: {e}")
+
+
+def add_cache_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--cache-dir', default=None,
+                        help='Activation cache shared across runs (default: no cache)')
+    parser.add_argument('--cache-size-gb', type=float, default=20.0,
+                        help='Size cap of the activation cache; LRU entries are evicted')
+
+
+def make_cache(args) -> ActivationCache:
+    """The ActivationCache asked for by add_cache_args options, or None."""
+    if not args.cache_dir:
+        return None
+    return ActivationCache(args.cache_dir, max_bytes=int(args.cache_size_gb * 2**30))
+
+
+def add_extraction_args(parser: argparse.ArgumentParser):
+    """Everything that configures an extraction run, whatever the model."""
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--flush', type=int, default=100)
+    add_encoding_args(parser)
+    parser.add_argument('--format', default='dense', choices=list(SHARD_FORMATS),
+                        help='Output format: dense compressed npz shards, sparse CSR npz '
+                             'shards, or a memory-mapped FeatureStore')
+    add_cache_args(parser)
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Flush chunks tokenized ahead of the model')
+    parser.add_argument('--tokenize-workers', type=int, default=1,
+                        help='Threads tokenizing upcoming chunks')
+    parser.add_argument('--pending-writes', type=int, default=2,
+                        help='Encoded chunks allowed to queue for the background writer')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Delete outputs written with different settings and start over '
+                             '(default: refuse to run)')
+    profiling.add_profile_arg(parser, 'a run report next to the outputs')
+
+
+def extraction_kwargs(args) -> dict:
+    """BaseExperiment keyword arguments from add_extraction_args options."""
+    return dict(flush_every=args.flush, batch_size=args.batch_size,
+                max_tokens=args.max_tokens_per_batch, window=args.window,
+                window_overlap=args.window_overlap, fmt=args.format,
+                prefetch=args.prefetch, tokenize_workers=args.tokenize_workers,
+                pending_writes=args.pending_writes, profile=args.profile,
+                overwrite=args.overwrite)
+
+
+def add_split_args(parser: argparse.ArgumentParser):
+    """One split extracted by one model: its data, output and worker layout."""
+    parser.add_argument('--jsonl', required=True)
+    parser.add_argument('--meta',  required=True)
+    parser.add_argument('--out',   required=True)
+    add_extraction_args(parser)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes, each with its own model replica')
+    parser.add_argument('--devices', default=None,
+                        help='Comma-separated devices assigned to workers round-robin '
+                             '(default: --device)')
+    parser.add_argument('--tokens', default=None,
+                        help='Token store of --jsonl from runners.run_tokenize (default: tokenize here)')
+
+
+def run_split(args, exp_cls: type, ext_cls: type, model_id: str, ext_info: dict):
+    """
+    Extract the add_split_args split with `ext_cls(model_id, ...)`, in one
+    process or, with --workers, through run_parallel (`ext_info` is the
+    extractor identity it checks the manifest against).
+    """
+    ds = TranscriptDataset(args.jsonl, args.meta)
+    cache = make_cache(args)
+    exp_kwargs = extraction_kwargs(args)
+    exp_kwargs['tokens'] = TokenStore(args.tokens) if args.tokens else None
+    if args.workers > 1:
+        devices = args.devices.split(',') if args.devices else [args.device]
+        make_extractor = partial(ext_cls, model_id, cache=cache)
+        run_parallel(exp_cls, make_extractor, ext_info, ds, args.out, args.workers, devices, **exp_kwargs)
+    else:
+        ext = ext_cls(model_id, args.device, cache=cache)
+        exp_cls(ext, ds, args.out, **exp_kwargs).run()
@@ -0,0 +1,296 @@
+import os
+# everything below is built locally: never reach for the hub
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+import torch
+from types import SimpleNamespace
+from typing import Dict, List
+from tokenizers import Tokenizer, models as tok_models, pre_tokenizers
+from tokenizers.processors import TemplateProcessing
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2Model, PreTrainedTokenizerFast
+from data_io import TranscriptDataset
+from token_store import TokenStore
+from models import SAEExtractor, ClsExtractor
+from experiments import SaeExperiment, ClsExperiment, SHARD_FORMATS
+import profiling
+from profiling import stage
+
+# the classifier scripts live outside any package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'classifiers'))
+import train_sae_fs
+from feature_selection import load_features, load_labels, rank_anova, rank_anova_streaming
+
+# feature directories are named like an SAE variant so train_sae_fs finds its k values
+BENCH_SAE_ID = 'sae_bench'
+
+
+def tiny_tokenizer(vocab_size: int, max_length: int) -> PreTrainedTokenizerFast:
+    """Word-level tokenizer over the words w0..w<vocab_size-1>, prepending a BOS token like Gemma's."""
+    vocab = {f"w{i}": i for i in range(vocab_size)}
+    vocab.update({'[UNK]': vocab_size, '[PAD]': vocab_size + 1, '[BOS]': vocab_size + 2})
+    tok = Tokenizer(tok_models.WordLevel(vocab, unk_token='[UNK]'))
+    tok.pre_tokenizer = pre_tokenizers.Whitespace()
+    tok.post_processor = TemplateProcessing(single='[BOS] $A', special_tokens=[('[BOS]', vocab_size + 2)])
+    return PreTrainedTokenizerFast(tokenizer_object=tok, unk_token='[UNK]', pad_token='[PAD]',
+                                   bos_token='[BOS]', model_max_length=max_length,
+                                   name_or_path=f"bench-wordlevel-{vocab_size}")
+
+
+class TinySAE(torch.nn.Module):
+    """Randomly initialised JumpReLU SAE encoder with the W_enc/b_enc/threshold layout of the real ones."""
+    def __init__(self, d_model: int, latent_dim: int):
+        super().__init__()
+        self.W_enc = torch.nn.Parameter(torch.randn(d_model, latent_dim) / d_model ** 0.5)
+        self.b_enc = torch.nn.Parameter(torch.zeros(latent_dim))
+        self.threshold = torch.nn.Parameter(torch.zeros(latent_dim))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        pre = x @ self.W_enc + self.b_enc
+        return torch.relu(pre) * (pre > self.threshold)
+
+    @torch.no_grad()
+    def calibrate(self, acts: torch.Tensor, density: float, spread: float = 3.0):
+        """
+        Set the thresholds from sample activations so latent firing rates are
+        heavy-tailed like a trained SAE's: each latent fires on a share of
+        tokens drawn log-uniformly from density * 10**-spread up to density.
+        """
+        pre = (acts[:4096] @ self.W_enc + self.b_enc).sort(dim=0).values
+        rates = density * 10.0 ** (-spread * torch.rand(pre.shape[1]))
+        rows = ((1.0 - rates) * (pre.shape[0] - 1)).long()
+        self.threshold.copy_(pre[rows, torch.arange(pre.shape[1])].clamp(min=0.0))
+
+
+def tiny_models(args) -> SimpleNamespace:
+    """The tokenizer, a GPT-2 style LM with an SAE for SAE runs, and a base model for CLS runs."""
+    torch.manual_seed(args.seed)
+    tokenizer = tiny_tokenizer(args.vocab, args.max_length)
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=args.max_length, n_embd=args.d_model,
+                        n_layer=args.n_layers, n_head=args.n_heads, bos_token_id=tokenizer.bos_token_id,
+                        eos_token_id=tokenizer.bos_token_id, pad_token_id=tokenizer.pad_token_id)
+    return SimpleNamespace(tokenizer=tokenizer, lm=GPT2LMHeadModel(config), base=GPT2Model(config),
+                           sae=TinySAE(args.d_model, args.latent_dim))
+
+
+def write_synthetic_dataset(out_dir: str, n_transcripts: int, mean_words: int, components: int,
+                            vocab_size: int, seed: int = 0):
+    """
+    Transcript JSONL (each transcript split into `components` component
+    lines) and a metadata CSV with a binary label. Words are Zipf
+    distributed; positive transcripts use a small set of signal words more
+    often, so feature selection has something to find. Returns the two paths.
+    """
+    rng = np.random.default_rng(seed)
+    p = 1.0 / np.arange(1, vocab_size + 1)
+    signal = rng.choice(vocab_size, size=max(1, vocab_size // 50), replace=False)
+    os.makedirs(out_dir, exist_ok=True)
+    jsonl_path = os.path.join(out_dir, 'transcripts.jsonl')
+    meta_path = os.path.join(out_dir, 'metadata.csv')
+    labels = rng.permutation(np.arange(n_transcripts) % 2)
+    with open(jsonl_path, 'w') as f:
+        for i, label in enumerate(labels):
+            probs = p.copy()
+            if label:
+                probs[signal] *= 5.0
+            n_words = int(rng.integers(max(1, mean_words // 2), 3 * mean_words // 2 + 1))
+            words = rng.choice(vocab_size, size=n_words, p=probs / probs.sum())
+            for part in np.array_split(words, components):
+                text = ' '.join(f"w{w}" for w in part)
+                f.write(json.dumps({'transcript_id': f"T{i:07d}", 'component_text': text}) + '\n')
+    pd.DataFrame({'transcript_id': [f"T{i:07d}" for i in range(n_transcripts)],
+                  'label': labels}).to_csv(meta_path, index=False)
+    return jsonl_path, meta_path
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def _scale(args) -> dict:
+    """The settings that make two benchmark runs comparable."""
+    keys = ['transcripts', 'words', 'components', 'vocab', 'max_length', 'n_layers', 'n_heads', 'd_model',
+            'latent_dim', 'sae_layers', 'density', 'batch_size', 'max_tokens_per_batch', 'flush',
+            'formats', 'tokens', 'threads', 'seed']
+    return {k: getattr(args, k) for k in keys}
+
+
+def run_benchmark(args) -> dict:
+    """
+    Generate the data, then time token-store building, SAE extraction in
+    every requested format, CLS extraction, load_features, ANOVA ranking
+    (in memory and streamed) and train_sae_fs end to end, all on CPU. The
+    inner stages of each step (forward, flush, fit.k<k>, ...) are recorded
+    alongside as in any profiled run. Returns the run report.
+    """
+    work = os.path.join(args.out, 'work')
+    shutil.rmtree(work, ignore_errors=True)  # extraction resumes; a benchmark must not
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    layers = [int(l) for l in args.sae_layers.split(',')]
+    view = f"mean_layer{layers[-1]}"
+    formats = args.formats.split(',')
+    ks = sorted({max(1, int(k)) for k in np.linspace(args.latent_dim / 10, args.latent_dim / 2, 5)})
+    train_sae_fs.K_VALUES[BENCH_SAE_ID] = ks
+
+    profiling.enable()
+    profiling.annotate(commit=_git_commit(), torch_threads=torch.get_num_threads(), ks=ks, view=view,
+                       **_scale(args))
+    with stage('bench.generate'):
+        jsonl, meta = write_synthetic_dataset(os.path.join(work, 'data'), args.transcripts, args.words,
+                                              args.components, args.vocab, args.seed)
+    ds = TranscriptDataset(jsonl, meta)
+    tiny = tiny_models(args)
+    sae_ext = SAEExtractor.from_components(tiny.tokenizer, tiny.lm, tiny.sae, layers, 'bench-lm', 'bench-sae')
+    cls_ext = ClsExtractor.from_components(tiny.tokenizer, tiny.base, 'bench-base')
+    # calibrate the SAE on real activations so output sparsity is realistic
+    probe = [text for _, text in ds.load_range(0, 32)]
+    probe_ids = tiny.tokenizer(probe, truncation=True, padding=True, return_tensors='pt')
+    with torch.no_grad():
+        acts = sae_ext._forward(probe_ids['input_ids'], probe_ids['attention_mask'], layers)
+    tiny.sae.calibrate(torch.cat([a[probe_ids['attention_mask'].bool()] for a in acts.values()]), args.density)
+
+    tokens = None
+    if args.tokens:
+        with stage('bench.tokenize_store'):
+            tokens = TokenStore.build(os.path.join(work, 'tokens'), ds, tiny.tokenizer)
+    exp_kwargs = dict(flush_every=args.flush, batch_size=args.batch_size,
+                      max_tokens=args.max_tokens_per_batch, tokens=tokens)
+    feature_dirs = {}
+    for fmt in formats:
+        feature_dirs[fmt] = os.path.join(work, fmt, BENCH_SAE_ID)
+        with stage(f'bench.extract_sae.{fmt}'):
+            SaeExperiment(sae_ext, ds, feature_dirs[fmt], fmt=fmt, **exp_kwargs).run()
+    with stage('bench.extract_cls'):
+        ClsExperiment(cls_ext, ds, os.path.join(work, 'dense', 'cls_bench'), **exp_kwargs).run()
+
+    for fmt in formats:
+        with stage(f'bench.load_features.{fmt}'):
+            X, y, _ = load_features(feature_dirs[fmt], view=view)
+    train_rows = np.arange(len(y))[: int(0.8 * len(y))]
+    with stage('bench.rank_anova'):
+        rank_anova(X[train_rows], y[train_rows])
+    for fmt in formats:
+        with stage(f'bench.rank_anova_streaming.{fmt}'):
+            rank_anova_streaming(feature_dirs[fmt], view=view, rows=train_rows)
+
+    fs_args = dict(feature_dir=feature_dirs[formats[0]], test_size=0.2, view=view, jobs=1,
+                   no_warm_start=False, export_k=None, profile=None)
+    with stage('bench.train_sae_fs'):
+        train_sae_fs.main(argparse.Namespace(out_dir=os.path.join(work, 'fs'), streaming=False, **fs_args))
+    with stage('bench.train_sae_fs.streaming'):
+        train_sae_fs.main(argparse.Namespace(out_dir=os.path.join(work, 'fs_streaming'), streaming=True,
+                                             **fs_args))
+    profiling.count('rows', len(load_labels(feature_dirs[formats[0]], view)[0]))
+
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    path = profiling.write_report(os.path.join(args.out, 'results'), f"bench_{stamp}")
+    with open(path, 'r') as f:
+        report = json.load(f)
+    report['stamp'] = stamp
+    print(f"Benchmark report written to {path}")
+    if not args.keep_work:
+        shutil.rmtree(work, ignore_errors=True)
+    return report
+
+
+def _history_row(report: dict) -> Dict[str, object]:
+    row = {'stamp': report['stamp'], 'commit': report['info'].get('commit', ''),
+           'scale': json.dumps({k: report['info'][k] for k in sorted(report['info'])
+                                if k not in ('commit', 'torch_threads', 'ks', 'view')}),
+           'wall_seconds': round(report['wall_seconds'], 4),
+           'tokens_per_sec': round(report['rates'].get('tokens_per_sec', 0.0), 1),
+           'host_peak_rss_bytes': report['host_peak_rss_bytes']}
+    for name, entry in report['stages'].items():
+        if name.startswith('bench.'):
+            row[name] = round(entry['seconds'], 4)
+    return row
+
+
+def append_history(history_path: str, report: dict) -> List[dict]:
+    """
+    Add this run to the history CSV (one row per run, one column per
+    benchmark step) and return the earlier rows run at the same scale.
+    """
+    rows = []
+    if os.path.exists(history_path):
+        with open(history_path, 'r', newline='') as f:
+            rows = list(csv.DictReader(f))
+    row = _history_row(report)
+    same_scale = [r for r in rows if r['scale'] == row['scale']]
+    rows.append(row)
+    columns = []
+    for r in rows:
+        columns.extend(c for c in r if c not in columns)
+    with open(history_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    return same_scale
+
+
+def print_comparison(report: dict, previous: dict = None):
+    """Seconds per benchmark step, against the last run at the same scale if there is one."""
+    ref = f"vs {previous['stamp']} ({previous['commit'] or 'no commit'})" if previous else ''
+    print(f"{'step':<36}{'seconds':>10}  {ref}")
+    for name, entry in report['stages'].items():
+        if not name.startswith('bench.'):
+            continue
+        line = f"{name:<36}{entry['seconds']:>10.3f}"
+        if previous and previous.get(name):
+            before = float(previous[name])
+            line += f"  {before:>9.3f}  {100.0 * (entry['seconds'] - before) / before:+6.1f}%"
+        print(line)
+    print(f"{'tokens/sec':<36}{report['rates'].get('tokens_per_sec', 0.0):>10.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline CPU benchmark of extraction, loading, '
+                                                 'selection and training on tiny random models')
+    parser.add_argument('--out', default='benchmarks',
+                        help='Directory for results/ (one report per run) and history.csv')
+    parser.add_argument('--transcripts', type=int, default=400)
+    parser.add_argument('--words', type=int, default=300, help='Mean words per transcript')
+    parser.add_argument('--components', type=int, default=4, help='Component lines per transcript')
+    parser.add_argument('--vocab', type=int, default=2000)
+    parser.add_argument('--max-length', type=int, default=256, help='Model context in tokens')
+    parser.add_argument('--n-layers', type=int, default=4)
+    parser.add_argument('--n-heads', type=int, default=4)
+    parser.add_argument('--d-model', type=int, default=64)
+    parser.add_argument('--latent-dim', type=int, default=1024, help='SAE latents')
+    parser.add_argument('--sae-layers', default='1,3', help='Comma-separated layers to encode')
+    parser.add_argument('--density', type=float, default=0.01,
+                        help='Highest share of tokens an SAE latent fires on; rarer latents '
+                             'go down to 1/1000 of it')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-tokens-per-batch', type=int, default=None)
+    parser.add_argument('--flush', type=int, default=100)
+    parser.add_argument('--formats', default='dense,csr,memmap',
+                        help=f"Comma-separated SAE output formats to time, from {SHARD_FORMATS}")
+    parser.add_argument('--tokens', action='store_true',
+                        help='Build a token store first and extract from it')
+    parser.add_argument('--threads', type=int, default=None, help='Torch CPU threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep-work', action='store_true',
+                        help='Keep the generated data and features under --out/work')
+    args = parser.parse_args()
+    unknown = set(args.formats.split(',')) - set(SHARD_FORMATS)
+    if unknown:
+        parser.error(f"Unknown formats {sorted(unknown)}")
+
+    report = run_benchmark(args)
+    previous = append_history(os.path.join(args.out, 'history.csv'), report)
+    print_comparison(report, previous[-1] if previous else None)
@@ -0,0 +1,123 @@
+import gc
+import time
+import argparse
+import pandas as pd
+from types import SimpleNamespace
+from typing import Dict, List
+from data_io import TranscriptDataset
+from activation_cache import ActivationCache
+from token_store import TokenStore
+from models import SAEExtractor, ClsExtractor
+from experiments import SaeExperiment, ClsExperiment
+from configs import SAE_MODELS, CLS_MODELS
+from runners._cli import add_extraction_args, check_encoding_args, extraction_kwargs, make_cache
+
+JOB_COLUMNS = ['model', 'jsonl', 'meta', 'out']
+
+
+def load_jobs(path: str) -> pd.DataFrame:
+    """
+    Read a job manifest: a CSV with one row per extraction job and columns
+    model (an SAE_MODELS or CLS_MODELS id), jsonl, meta and out, plus an
+    optional tokens column naming the job's token store (see run_tokenize).
+    """
+    jobs = pd.read_csv(path)
+    missing = [c for c in JOB_COLUMNS if c not in jobs.columns]
+    if missing:
+        raise ValueError(f"Job manifest {path} lacks columns {missing}")
+    unknown = sorted(set(jobs['model']) - set(SAE_MODELS) - set(CLS_MODELS))
+    if unknown:
+        raise ValueError(f"Unknown model ids in {path}: {unknown}")
+    return jobs
+
+
+def group_by_model(jobs: pd.DataFrame) -> Dict[str, List[int]]:
+    """Row positions of each model's jobs, models in order of first appearance."""
+    groups = {}
+    for i, model_id in enumerate(jobs['model']):
+        groups.setdefault(model_id, []).append(i)
+    return groups
+
+
+def _experiment(model_id: str, ext, job, exp_kwargs: dict):
+    exp_cls = SaeExperiment if model_id in SAE_MODELS else ClsExperiment
+    tokens = job.get('tokens')
+    tokens = TokenStore(tokens) if isinstance(tokens, str) and tokens else None
+    return exp_cls(ext, TranscriptDataset(job.jsonl, job.meta), job.out, tokens=tokens, **exp_kwargs)
+
+
+def _identity(model_id: str) -> SimpleNamespace:
+    # what an experiment reads off its extractor to check the manifest
+    if model_id in SAE_MODELS:
+        return SimpleNamespace(**SAE_MODELS[model_id])
+    return SimpleNamespace(hf_model=CLS_MODELS[model_id])
+
+
+def run_jobs(jobs: pd.DataFrame, device: str, exp_kwargs: dict, cache: ActivationCache = None,
+             report_path: str = None) -> pd.DataFrame:
+    """
+    Run every job, one model at a time: each model is loaded once, runs all
+    of its jobs, then is released before the next model is loaded. Jobs whose
+    outputs are already complete are skipped without loading the model, and
+    a failing job is recorded and does not stop the others. Returns (and
+    optionally writes to report_path) one status row per job.
+    """
+    report = []
+    n_done = 0
+    for model_id, rows in group_by_model(jobs).items():
+        todo = [i for i in rows
+                if not _experiment(model_id, _identity(model_id), jobs.iloc[i], exp_kwargs).is_complete()]
+        for i in rows:
+            if i not in todo:
+                n_done += 1
+                report.append(dict(job=i, model=model_id, out=jobs.iloc[i].out, status='skipped', seconds=0.0))
+                print(f"[{n_done}/{len(jobs)}] {model_id} -> {jobs.iloc[i].out}: already complete")
+        if not todo:
+            continue
+        start = time.perf_counter()
+        if model_id in SAE_MODELS:
+            ext = SAEExtractor(model_id, device, cache=cache)
+        else:
+            ext = ClsExtractor(model_id, device, cache=cache)
+        print(f"Loaded {model_id} in {time.perf_counter() - start:.1f}s for {len(todo)} jobs")
+        for i in todo:
+            job = jobs.iloc[i]
+            start = time.perf_counter()
+            try:
+                _experiment(model_id, ext, job, exp_kwargs).run()
+                status = 'done'
+            except Exception as e:
+                status = f"failed: {e!r}"
+            seconds = time.perf_counter() - start
+            n_done += 1
+            report.append(dict(job=i, model=model_id, out=job.out, status=status, seconds=round(seconds, 1)))
+            print(f"[{n_done}/{len(jobs)}] {model_id} -> {job.out}: {status} in {seconds:.1f}s")
+            if report_path:
+                pd.DataFrame(report).to_csv(report_path, index=False)
+        # release the weights before the next model comes in
+        del ext
+        gc.collect()
+        if device.startswith('cuda'):
+            import torch
+            torch.cuda.empty_cache()
+    report = pd.DataFrame(report).sort_values('job').reset_index(drop=True)
+    if report_path:
+        report.to_csv(report_path, index=False)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', required=True,
+                        help='CSV manifest with columns model, jsonl, meta, out')
+    parser.add_argument('--report', default=None,
+                        help='Write per-job status and timing to this CSV')
+    add_extraction_args(parser)
+    args = parser.parse_args()
+    check_encoding_args(parser, args)
+
+    report = run_jobs(load_jobs(args.jobs), args.device, extraction_kwargs(args), cache=make_cache(args),
+                      report_path=args.report)
+    failed = report[report['status'].str.startswith('failed')]
+    if len(failed):
+        raise SystemExit(f"{len(failed)} of {len(report)} jobs failed; re-run to resume them")
@@ -0,0 +1,26 @@
+import argparse
+from transformers import AutoTokenizer
+from data_io import TranscriptDataset
+from token_store import TokenStore
+from configs import SAE_MODELS, CLS_MODELS
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jsonl', required=True)
+    parser.add_argument('--meta',  required=True)
+    parser.add_argument('--out',   required=True, help='Directory of the token store')
+    parser.add_argument('--model', required=True,
+                        choices=list(SAE_MODELS.keys()) + list(CLS_MODELS.keys()),
+                        help="Model whose tokenizer to use; models with the same tokenizer "
+                             "(e.g. every Gemma-2 variant) can share the store")
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Threads tokenizing chunks of transcripts in parallel')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='Transcripts per tokenizer call')
+    args = parser.parse_args()
+
+    hf_model = SAE_MODELS[args.model]['hf_model'] if args.model in SAE_MODELS else CLS_MODELS[args.model]
+    tokenizer = AutoTokenizer.from_pretrained(hf_model)
+    store = TokenStore.build(args.out, TranscriptDataset(args.jsonl, args.meta), tokenizer,
+                             workers=args.workers, chunk_size=args.chunk_size)
+    print(f"Tokenized {len(store)} transcripts ({store.header['tokens']} tokens) into {args.out}")
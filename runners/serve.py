@@ -0,0 +1,195 @@
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from functools import partial
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+from scoring import ScoringModel
+from runners._cli import add_encoding_args, add_cache_args, check_encoding_args, make_cache
+
+class MicroBatcher:
+    """
+    Groups concurrent scoring requests into batches for one model. A batch
+    is dispatched once it holds max_batch texts or its oldest request has
+    waited max_wait_ms, whichever comes first, but requests already queued
+    are always taken up to max_batch, however long they have waited. A
+    single thread runs the batches, so every forward pass sees the whole
+    batch at once. Keeps the latencies and batch sizes of the last `history`
+    requests for stats().
+    """
+    def __init__(self, score_fn: Callable[[List[str]], np.ndarray], max_batch: int = 16,
+                 max_wait_ms: float = 20.0, history: int = 10000):
+        self.score_fn = score_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue one request; the future resolves to its list of probabilities."""
+        future = Future()
+        self.queue.put((list(texts), future, time.perf_counter()))
+        return future
+
+    def _next_batch(self) -> list:
+        batch = [self.queue.get()]
+        n = len(batch[0][0])
+        deadline = batch[0][2] + self.max_wait
+        while n < self.max_batch:
+            try:
+                # a backlog fills the batch at once; only an empty queue is waited on
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            batch.append(item)
+            n += len(item[0])
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for item in batch for text in item[0]]
+            try:
+                probas = np.asarray(self.score_fn(texts))
+            except Exception as e:
+                with self._lock:
+                    self.errors += len(batch)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            done = time.perf_counter()
+            pos = 0
+            for item_texts, future, start in batch:
+                future.set_result(probas[pos:pos + len(item_texts)].tolist())
+                pos += len(item_texts)
+            with self._lock:
+                self.requests += len(batch)
+                self.batch_sizes.append(len(texts))
+                self.latencies.extend(done - start for _, _, start in batch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000.0
+            sizes = np.array(self.batch_sizes)
+            out = {'queue_depth': self.queue.qsize(), 'requests': self.requests,
+                   'errors': self.errors, 'batches': len(sizes),
+                   'mean_batch_size': float(sizes.mean()) if len(sizes) else 0.0}
+        for p in (50, 90, 99):
+            out[f'latency_p{p}_ms'] = float(np.percentile(latencies, p)) if len(latencies) else None
+        return out
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    """
+    POST /score with {"texts": [...]} (or {"text": "..."}) returns
+    {"probabilities": [...]}; GET /stats returns the batcher's stats and
+    GET /health a liveness check.
+    """
+    batcher: MicroBatcher = None
+    timeout_s: float = 60.0
+    quiet: bool = True
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.batcher.stats())
+        elif self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/score':
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            if 'texts' in request:
+                texts = request['texts']
+            elif 'text' in request:
+                texts = [request['text']]
+            else:
+                raise ValueError("Expected {\"texts\": [...]} or {\"text\": \"...\"}")
+            if not isinstance(texts, list) or not texts or not all(isinstance(t, str) for t in texts):
+                raise ValueError("'texts' must be a non-empty list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        try:
+            probas = self.batcher.submit(texts).result(timeout=self.timeout_s)
+        except Exception as e:
+            self._send_json(500, {'error': repr(e)})
+            return
+        self._send_json(200, {'probabilities': probas})
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(batcher: MicroBatcher, host: str = '127.0.0.1', port: int = 8080,
+                timeout_s: float = 60.0, quiet: bool = True) -> ThreadingHTTPServer:
+    handler = type('Handler', (ScoringHandler,), {'batcher': batcher, 'timeout_s': timeout_s,
+                                                   'quiet': quiet})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', required=True,
+                        help='Scoring model exported by train_sae_fs --export-k')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=16,
+                        help='Texts gathered into one scoring batch')
+    parser.add_argument('--max-wait-ms', type=float, default=20.0,
+                        help='Longest a request waits for its batch to fill')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='Seconds before a request gives up on its result')
+    add_encoding_args(parser, batch_size=8)
+    add_cache_args(parser)
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+    check_encoding_args(parser, args)
+
+    model = ScoringModel.load(args.model)
+    ext = model.extractor(args.device, cache=make_cache(args))
+    score_fn = partial(model.predict_proba, extractor=ext, batch_size=args.batch_size,
+                       max_tokens=args.max_tokens_per_batch, window=args.window,
+                       overlap=args.window_overlap)
+    batcher = MicroBatcher(score_fn, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+    server = make_server(batcher, args.host, args.port, timeout_s=args.timeout, quiet=not args.verbose)
+    print(f"Scoring {model.view} of {model.sae_id} ({len(model.features)} latents) "
+          f"on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
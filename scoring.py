@@ -0,0 +1,47 @@
+import re
+import joblib
+import numpy as np
+from typing import List
+
+# <stat>_layer<L>, e.g. 'mean_layer20'
+VIEW_RE = re.compile(r'^([a-z]+)_layer(\d+)$')
+
+class ScoringModel:
+    """
+    A trained feature-selection classifier together with what is needed to
+    score raw transcripts: the SAE variant, the pooled view it was trained on
+    and the selected latent indices, in the column order the classifier
+    expects. Saved with joblib by train_sae_fs --export-k.
+    """
+    def __init__(self, sae_id: str, view: str, features: List[int], classifier):
+        m = VIEW_RE.match(view)
+        if m is None:
+            raise ValueError(f"View '{view}' does not name an SAE layer, e.g. 'mean_layer20'")
+        self.sae_id = sae_id
+        self.view = view
+        self.stat = m.group(1)
+        self.layer = int(m.group(2))
+        self.features = [int(f) for f in features]
+        self.classifier = classifier
+
+    def save(self, path: str):
+        joblib.dump({'sae_id': self.sae_id, 'view': self.view,
+                     'features': self.features, 'classifier': self.classifier}, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ScoringModel':
+        return cls(**joblib.load(path))
+
+    def extractor(self, device: str = 'cpu', cache=None):
+        """An SAEExtractor pruned to the selected latents at the trained layer."""
+        from models import SAEExtractor
+        return SAEExtractor(self.sae_id, device=device, cache=cache).prune(self.features, self.layer)
+
+    def predict_proba(self, texts: List[str], extractor, **encode_kwargs) -> np.ndarray:
+        """
+        Positive-class probability for each text, from a pruned extractor
+        (see extractor()); `encode_kwargs` go to encode_batch.
+        """
+        pooled = extractor.encode_batch(list(texts), [self.layer], **encode_kwargs)
+        X = np.stack([per_text[self.layer][self.stat] for per_text in pooled])
+        return self.classifier.predict_proba(X)[:, 1]
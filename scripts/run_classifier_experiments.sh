@@ -5,6 +5,7 @@ set -euo pipefail
 FEATURE_ROOT="data/doc_features/sae"
 OUT_ROOT="results/predictions/sae_fs"
 VARIANTS=("sae_2b" "sae_9b_131k")
+VIEW="mean_layer20"
 
 for var in "${VARIANTS[@]}"; do
   in_dir="$FEATURE_ROOT/$var"
@@ -13,6 +14,7 @@ for var in "${VARIANTS[@]}"; do
   python classifiers/train_sae_fs.py \
     --feature-dir "$in_dir" \
     --out-dir "$out_dir" \
+    --view "$VIEW" \
     --test-size 0.2
 done
 
@@ -28,10 +30,12 @@ for var in sae_2b sae_9b_131k; do
   python classifiers/train_baselines.py \
     --feature-dir "$in_dir" \
     --out-dir "$out_dir" \
+    --view "$VIEW" \
     --test-size 0.2
 done
 
 # CLS baseline (MLP + LR)
+VIEW="mean"
 for var in cls_gemma_2b cls_gemma_9b cls_qwen_4b cls_llama_3b; do
   in_dir="$FEATURE_ROOT/cls/$var"
   out_dir="$OUT_ROOT/cls_baseline/$var"
@@ -39,5 +43,6 @@ for var in cls_gemma_2b cls_gemma_9b cls_qwen_4b cls_llama_3b; do
   python classifiers/train_baselines.py \
     --feature-dir "$in_dir" \
     --out-dir "$out_dir" \
+    --view "$VIEW" \
     --test-size 0.2
 done
\ No newline at end of file
@@ -4,18 +4,37 @@ set -euo pipefail
 YEARS=(2012 2013 2014)
 ORDERS=(1 2)
 SAE_IDS=(sae_2b sae_9b_16k sae_9b_131k)
+JOBS="data/doc_features/sae/jobs.csv"
+TOKENS="data/tokens/gemma-2"
 
+# every SAE sits on a Gemma-2 model with the same tokenizer: tokenize each split once
+for year in "${YEARS[@]}"; do
+  for order in "${ORDERS[@]}"; do
+    if [ ! -f "$TOKENS/${year}_${order}/tokens.json" ]; then
+      echo "→ Tokenizing ${year}_${order}"
+      python -m runners.run_tokenize \
+        --jsonl data/train_test_data/transcript_componenttext_${year}_${order}.jsonl \
+        --meta  data/train_test_data/transcript_metadata_${year}_${order}.csv \
+        --out   "$TOKENS/${year}_${order}" \
+        --model sae_2b
+    fi
+  done
+done
+
+# one job per (model, split); the scheduler loads each model once for all its splits
+mkdir -p "$(dirname "$JOBS")"
+echo "model,jsonl,meta,out,tokens" > "$JOBS"
 for sae in "${SAE_IDS[@]}"; do
   for year in "${YEARS[@]}"; do
     for order in "${ORDERS[@]}"; do
-      echo "→ SAE features for $sae ${year}_${order}"
-      python -m runners.run_sae \
-        --jsonl data/train_test_data/transcript_componenttext_${year}_${order}.jsonl \
-        --meta  data/train_test_data/transcript_metadata_${year}_${order}.csv \
-        --out   data/doc_features/sae/${sae}/${year}_${order} \
-        --sae-id "$sae" \
-        --flush 100
+      echo "$sae,data/train_test_data/transcript_componenttext_${year}_${order}.jsonl,data/train_test_data/transcript_metadata_${year}_${order}.csv,data/doc_features/sae/${sae}/${year}_${order},$TOKENS/${year}_${order}" >> "$JOBS"
     done
   done
+done
 
-done
\ No newline at end of file
+echo "→ SAE features for ${SAE_IDS[*]}"
+python -m runners.run_jobs \
+  --jobs "$JOBS" \
+  --report data/doc_features/sae/jobs_report.csv \
+  --format csr \
+  --flush 100
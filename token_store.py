@@ -0,0 +1,190 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple
+from activation_cache import ActivationCache
+
+HEADER = 'tokens.json'
+IDS = 'ids.csv'
+
+def tokenizer_vocab_fingerprint(tokenizer) -> str:
+    """
+    Hash of what a tokenizer does to text (normalizer, pre-tokenizer, vocab,
+    special-token post-processing), independent of the checkpoint it was
+    loaded from, so e.g. Gemma-2-2b and Gemma-2-9b share token ids.
+    """
+    backend = getattr(tokenizer, 'backend_tokenizer', None)
+    if backend is not None:
+        spec = json.loads(backend.to_str())
+        # per-call settings the tokenizer mutates, not part of what it does to text
+        spec.pop('truncation', None)
+        spec.pop('padding', None)
+        spec = json.dumps(spec, sort_keys=True)
+    else:
+        spec = json.dumps([type(tokenizer).__name__, sorted(tokenizer.get_vocab().items()),
+                           tokenizer('x')['input_ids']])
+    return hashlib.sha256(spec.encode('utf-8')).hexdigest()
+
+def special_layout(tokenizer) -> Tuple[int, int]:
+    """Number of special tokens the tokenizer adds before and after the text."""
+    ids = tokenizer('x')['input_ids']
+    body = tokenizer('x', add_special_tokens=False)['input_ids']
+    for p in range(len(ids) - len(body) + 1):
+        if ids[p:p + len(body)] == body:
+            return p, len(ids) - p - len(body)
+    raise ValueError(f"Cannot locate the text among the special tokens of {tokenizer.name_or_path}")
+
+class TokenStore:
+    """
+    A TranscriptDataset tokenized once, untruncated: token ids of every
+    transcript back to back in tokens.i32, end offsets in offsets.i64, and
+    ids.csv with each transcript_id and the hash of its text. tokens.json
+    records the tokenizer fingerprint, where it puts special tokens and the
+    source JSONL's size and mtime. Any extractor whose tokenizer has the same
+    fingerprint can read its (optionally truncated) sequences instead of
+    tokenizing, whatever checkpoint it belongs to.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        path = os.path.join(root, HEADER)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No token store in {root}; build one with runners.run_tokenize")
+        with open(path, 'r') as f:
+            self.header = json.load(f)
+        self._ids = None
+        self._tokens = None
+        self._offsets = None
+
+    @staticmethod
+    def exists(root: str) -> bool:
+        return os.path.exists(os.path.join(root, HEADER))
+
+    @classmethod
+    def build(cls, root: str, dataset: Any, tokenizer, workers: int = 4,
+              chunk_size: int = 256) -> 'TokenStore':
+        """
+        Tokenize `dataset` into a new store at `root`, `workers` chunks of
+        `chunk_size` transcripts at a time, each on its own thread.
+        """
+        from models import _thread_tokenizer  # per-thread copies of the fast tokenizer
+
+        def tokenize(start: int):
+            pairs = dataset.load_range(start, start + chunk_size)
+            texts = [text for _, text in pairs]
+            ids = _thread_tokenizer(tokenizer)(texts, truncation=False)['input_ids']
+            return pairs, ids
+
+        os.makedirs(root, exist_ok=True)
+        _remove_header(root)
+        n = len(dataset)
+        starts = iter(range(0, n, chunk_size))
+        pending = deque()
+        rows, end = [], 0
+        with open(os.path.join(root, 'tokens.i32'), 'wb') as tok_f, \
+                open(os.path.join(root, 'offsets.i64'), 'wb') as off_f, \
+                ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in starts:
+                pending.append(pool.submit(tokenize, start))
+                if len(pending) >= 2 * workers:
+                    break
+            while pending:
+                pairs, ids = pending.popleft().result()
+                nxt = next(starts, None)
+                if nxt is not None:
+                    pending.append(pool.submit(tokenize, nxt))
+                lengths = np.array([len(seq) for seq in ids], dtype=np.int64)
+                tok_f.write(np.concatenate([np.asarray(seq, dtype=np.int32) for seq in ids]
+                                           or [np.empty(0, np.int32)]).tobytes())
+                off_f.write((end + np.cumsum(lengths)).tobytes())
+                end += int(lengths.sum())
+                rows.extend((tid, ActivationCache.text_hash(text)) for tid, text in pairs)
+        pd.DataFrame(rows, columns=['transcript_id', 'text_hash']).to_csv(os.path.join(root, IDS), index=False)
+        st = os.stat(dataset.jsonl_path)
+        header = {
+            'rows': len(rows),
+            'tokens': end,
+            'fingerprint': tokenizer_vocab_fingerprint(tokenizer),
+            'special_layout': list(special_layout(tokenizer)),
+            'tokenizer': tokenizer.name_or_path,
+            'source': {'jsonl': os.path.abspath(dataset.jsonl_path), 'size': st.st_size,
+                       'mtime_ns': st.st_mtime_ns},
+        }
+        # the header goes last: a store without one is an unfinished build
+        tmp = os.path.join(root, HEADER + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(header, f, indent=2)
+        os.replace(tmp, os.path.join(root, HEADER))
+        return cls(root)
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in worker processes
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        state['_offsets'] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.header['rows']
+
+    @property
+    def fingerprint(self) -> str:
+        return self.header['fingerprint']
+
+    def _open(self):
+        if self._offsets is None:
+            n, total = self.header['rows'], self.header['tokens']
+            ends = np.fromfile(os.path.join(self.root, 'offsets.i64'), dtype=np.int64, count=n)
+            self._offsets = np.concatenate([[0], ends])
+            self._tokens = (np.memmap(os.path.join(self.root, 'tokens.i32'), dtype=np.int32, mode='r',
+                                      shape=(total,)) if total else np.empty(0, dtype=np.int32))
+        return self._tokens, self._offsets
+
+    def ids(self) -> pd.DataFrame:
+        if self._ids is None:
+            self._ids = pd.read_csv(os.path.join(self.root, IDS))
+        return self._ids
+
+    def transcript_ids(self) -> List[str]:
+        return self.ids()['transcript_id'].tolist()
+
+    def text_hashes(self, start: int = 0, stop: int = None) -> List[str]:
+        return self.ids()['text_hash'].iloc[start:stop].tolist()
+
+    def lengths(self) -> np.ndarray:
+        """Untruncated token count of every transcript."""
+        return np.diff(self._open()[1])
+
+    def seqs(self, start: int = 0, stop: int = None, max_length: int = None) -> List[List[int]]:
+        """
+        Token ids of transcripts start..stop-1. With max_length, sequences are
+        truncated the way the tokenizer would (special tokens kept).
+        """
+        tokens, offsets = self._open()
+        stop = len(self) if stop is None else min(stop, len(self))
+        _, suffix = self.header['special_layout']
+        out = []
+        for i in range(start, stop):
+            seq = tokens[offsets[i]:offsets[i + 1]]
+            if max_length is not None and len(seq) > max_length:
+                seq = np.concatenate([seq[:max_length - suffix], seq[len(seq) - suffix:]])
+            out.append(seq.tolist())
+        return out
+
+    def check(self, dataset: Any, tokenizer):
+        """Raise ValueError unless this store holds `dataset`'s transcripts tokenized by `tokenizer`."""
+        if tokenizer_vocab_fingerprint(tokenizer) != self.fingerprint:
+            raise ValueError(f"Token store {self.root} was built with a different tokenizer "
+                             f"({self.header['tokenizer']}) than {tokenizer.name_or_path}")
+        # texts are checked chunk by chunk against text_hashes() as they are read
+        if self.transcript_ids() != list(dataset.transcript_ids()):
+            raise ValueError(f"Token store {self.root} is out of date for {dataset.jsonl_path}; rebuild it")
+
+def _remove_header(root: str):
+    try:
+        os.remove(os.path.join(root, HEADER))
+    except FileNotFoundError:
+        pass